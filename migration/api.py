@@ -1,126 +1,416 @@
+import itertools
 import logging
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from enum import Enum
 from json import JSONDecodeError
-from typing import Any
-from urllib.parse import parse_qs, urlparse
+from typing import Any, AsyncIterator
+from urllib.parse import unquote_plus
 
 import httpx
 import trio
+from cachetools import TTLCache
 from tenacity import (
+    RetryCallState,
     before_sleep_log,
     retry,
-    retry_if_exception_type,
-    stop_after_attempt
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter
 )
+from tenacity.wait import wait_base
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson has no wheels for some platforms
+    from json import loads as json_loads
 
 logger = logging.getLogger(__name__)
 
 MAX_ATTEMPT_NUM = 4
 MAX_ASYNC_CONNS = 20
+KEEPALIVE_EXPIRY = 30.0
+CONNECT_TIMEOUT = 10.0
+CACHE_MAX_SIZE = 4096
+CACHE_TTL = 300
+RETRY_WAIT_INITIAL = 1.0
+RETRY_WAIT_MAX = 30.0
+RETRY_WAIT_JITTER = 1.0
+PAGE_WINDOW = 10
 
 
 class EndpointType(Enum):
     REST = '/api/v1/'
 
 
-@dataclass
+class CacheMode(Enum):
+    NONE = 'none'
+    READ_ONLY = 'readonly'
+    READ_WRITE = 'readwrite'
+
+
+# Query params as name/value pairs, so repeated names (e.g., include[])
+# keep all of their values
+QueryPairs = list[tuple[str, str]]
+
+
+@dataclass(slots=True)
 class GetResponse:
     data: Any
-    next_page_params: dict[str, Any] | None
+    next_page_params: QueryPairs | None
+    last_page_num: int | None = None
+
+
+def is_retryable(exception: BaseException) -> bool:
+    """
+    Client errors other than 429 won't succeed on retry, so only server
+    errors, rate limiting, transport and decoding errors are retried
+    """
+    if isinstance(exception, httpx.HTTPStatusError):
+        status_code = exception.response.status_code
+        return (status_code == httpx.codes.TOO_MANY_REQUESTS or
+                status_code >= httpx.codes.INTERNAL_SERVER_ERROR)
+    # orjson's decoding error subclasses the standard library's
+    return isinstance(exception, (httpx.HTTPError, JSONDecodeError))
+
+
+class wait_retry_after(wait_base):
+    """
+    Wait strategy that honors the Retry-After header of a 429 response, up
+    to a maximum, deferring to a fallback strategy for any other failure
+    """
+
+    def __init__(self, fallback: wait_base, max: float = RETRY_WAIT_MAX):
+        self.fallback = fallback
+        self.max = max
+
+    def __call__(self, retry_state: RetryCallState) -> float:
+        exception = (retry_state.outcome.exception()
+                     if retry_state.outcome is not None else None)
+        if (
+                isinstance(exception, httpx.HTTPStatusError) and
+                exception.response.status_code ==
+                httpx.codes.TOO_MANY_REQUESTS
+        ):
+            retry_after = exception.response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), self.max)
+        return self.fallback(retry_state)
+
+
+@dataclass(frozen=True, slots=True)
+class CacheEntry:
+    response: GetResponse
+    etag: str | None
+    must_revalidate: bool
 
 
 class API:
     client: httpx.AsyncClient
+    cache: TTLCache
+    cache_mode: CacheMode
 
     def __init__(
             self,
             url: str,
             key: str,
             endpoint_type: EndpointType = EndpointType.REST,
-            timeout: float = 10.0
+            timeout: float = 30.0,
+            cache_mode: CacheMode = CacheMode.READ_WRITE,
+            max_connections: int = MAX_ASYNC_CONNS,
+            http2: bool = True,
+            transport: httpx.AsyncBaseTransport | None = None
     ):
-        headers = {'Authorization': f'Bearer {key}'}
-        timeoutsConfiguration = httpx.Timeout(timeout, pool=None)
-        limits = httpx.Limits(max_connections=MAX_ASYNC_CONNS)
+        headers = {
+            'Authorization': f'Bearer {key}',
+            # Only advertise encodings httpx can decode (br via its extra)
+            'Accept-Encoding': 'br, gzip, deflate'
+        }
+        timeoutsConfiguration = httpx.Timeout(
+            timeout, connect=CONNECT_TIMEOUT, pool=None)
+        # Keep every pooled connection alive so sockets are reused across
+        # course requests instead of being churned
+        limits = httpx.Limits(max_connections=max_connections,
+                              max_keepalive_connections=max_connections,
+                              keepalive_expiry=KEEPALIVE_EXPIRY)
+        # HTTP/2 is negotiated via ALPN; HTTP/1.1 is used if unsupported
         self.client = httpx.AsyncClient(
             base_url=url + endpoint_type.value,
             headers=headers,
             timeout=timeoutsConfiguration,
-            limits=limits
+            limits=limits,
+            http2=http2,
+            transport=transport
         )
+        self.cache = TTLCache(maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL)
+        self.cache_mode = cache_mode
+
+    @staticmethod
+    def get_query_params(url: str) -> QueryPairs:
+        _, separator, query = url.rpartition('?')
+        if not separator:
+            return []
+        return [
+            (unquote_plus(name), unquote_plus(value))
+            for part in query.split('&') if part
+            for name, _, value in [part.partition('=')]
+        ]
 
     @staticmethod
-    def get_next_page_params(resp: httpx.Response) -> dict[str, Any] | None:
-        if 'next' not in resp.links:
+    def get_next_page_params(resp: httpx.Response) -> QueryPairs | None:
+        # Response.links parses the Link header on every access
+        next_link = resp.links.get('next')
+        if next_link is None:
             return None
         else:
-            query_params = parse_qs(urlparse(resp.links['next']['url']).query)
-            return query_params
+            return API.get_query_params(next_link['url'])
+
+    @staticmethod
+    def get_last_page_num(resp: httpx.Response) -> int | None:
+        last_link = resp.links.get('last')
+        if last_link is None:
+            return None
+        query_params = dict(API.get_query_params(last_link['url']))
+        page = query_params.get('page', '')
+        # Some endpoints paginate with opaque bookmarks instead of numbers
+        return int(page) if page.isdigit() else None
+
+    def resolve_url(self, endpoint: str) -> httpx.URL:
+        """
+        Resolves an endpoint against the client's base URL once, so repeated
+        requests to it (e.g., for each page) skip merging the URLs
+        """
+        base_url = self.client.base_url
+        return base_url.copy_with(
+            raw_path=base_url.raw_path + endpoint.lstrip('/').encode('ascii'))
+
+    @staticmethod
+    def merge_page_params(base_params: dict[str, Any],
+                          page_params: QueryPairs) -> list[tuple[str, Any]]:
+        """
+        Adds a page's params to the caller's.  Link URLs repeat the caller's
+        params, so for those names the caller's values, all of them, win.
+        """
+        return [*httpx.QueryParams(base_params).multi_items(),
+                *((name, value) for name, value in page_params
+                  if name not in base_params)]
+
+    @staticmethod
+    def get_cache_key(url: str | httpx.URL,
+                      params: dict[str, Any] | list[tuple[str, Any]] | None
+                      ) -> tuple:
+        # QueryParams flattens list values and stringifies them all, so the
+        # key is hashable and the same however the params were given
+        return (str(url),
+                tuple(sorted(httpx.QueryParams(params or {}).multi_items())))
+
+    @staticmethod
+    def get_cache_directives(resp: httpx.Response) -> set[str]:
+        cache_control = resp.headers.get('Cache-Control', '')
+        return {directive.strip().lower()
+                for directive in cache_control.split(',')}
 
     @retry(
         stop=stop_after_attempt(MAX_ATTEMPT_NUM),
-        retry=retry_if_exception_type((httpx.HTTPError, JSONDecodeError)),
+        retry=retry_if_exception(is_retryable),
+        wait=wait_retry_after(wait_exponential_jitter(
+            initial=RETRY_WAIT_INITIAL, max=RETRY_WAIT_MAX,
+            jitter=RETRY_WAIT_JITTER)),
         reraise=True,
         before_sleep=before_sleep_log(logger, logging.WARN),
         sleep=trio.sleep
     )
-    async def get(self, url: str,
-                  params: dict[str, Any] | None = None) -> GetResponse:
-        resp = await self.client.get(url=url, params=params)
+    async def get(self, url: str | httpx.URL,
+                  params: dict[str, Any] | list[tuple[str, Any]] | None = None,
+                  cache_mode: CacheMode | None = None) -> GetResponse:
+        if cache_mode is None:
+            cache_mode = self.cache_mode
+
+        cache_key = self.get_cache_key(url, params)
+        entry: CacheEntry | None = None
+        headers: dict[str, str] = {}
+        if cache_mode is not CacheMode.NONE:
+            entry = self.cache.get(cache_key)
+            if entry is not None:
+                if not entry.must_revalidate:
+                    return entry.response
+                if entry.etag is not None:
+                    headers['If-None-Match'] = entry.etag
+
+        resp = await self.client.get(url=url, params=params, headers=headers)
+        if resp.status_code == httpx.codes.NOT_MODIFIED and entry is not None:
+            return entry.response
         resp.raise_for_status()
-        data = resp.json()
+        data = json_loads(resp.content)
         next_page_params = self.get_next_page_params(resp)
-        return GetResponse(data, next_page_params)
+        last_page_num = self.get_last_page_num(resp)
+        get_resp = GetResponse(data, next_page_params, last_page_num)
+
+        # Canvas marks its responses "max-age=0, private, must-revalidate",
+        # so in practice each cache hit is still a request, revalidated with
+        # If-None-Match.  What the cache saves is the body transfer and JSON
+        # decoding when a 304 says the response hasn't changed.  Listing
+        # pages are read once per run, so send_pages doesn't cache them.
+        directives = self.get_cache_directives(resp)
+        if cache_mode is CacheMode.READ_WRITE and 'no-store' not in directives:
+            self.cache[cache_key] = CacheEntry(
+                response=get_resp,
+                etag=resp.headers.get('ETag'),
+                must_revalidate=bool(
+                    {'no-cache', 'max-age=0'} & directives))
+        return get_resp
 
     @retry(
         stop=stop_after_attempt(MAX_ATTEMPT_NUM),
-        retry=retry_if_exception_type((httpx.HTTPError, JSONDecodeError)),
+        retry=retry_if_exception(is_retryable),
+        wait=wait_retry_after(wait_exponential_jitter(
+            initial=RETRY_WAIT_INITIAL, max=RETRY_WAIT_MAX,
+            jitter=RETRY_WAIT_JITTER)),
         reraise=True,
         before_sleep=before_sleep_log(logger, logging.WARN),
         sleep=trio.sleep
     )
-    async def put(self, url: str, params: dict[str, Any] | None = None) -> Any:
+    async def put(
+            self, url: str,
+            params: dict[str, Any] | tuple[tuple[str, str], ...] | None = None
+    ) -> Any:
         resp = await self.client.put(url=url, params=params)
         if resp.status_code == httpx.codes.UNPROCESSABLE_ENTITY:
-            logger.warning(
-                f'HTTP {resp.status_code}: PUT {resp.url}; '
-                f'response: {repr(resp.text)}')
+            logger.warning('HTTP %d: PUT %s; response: %r',
+                           resp.status_code, resp.url, resp.text)
             return None
         resp.raise_for_status()
-        return resp.json()
+        return json_loads(resp.content)
 
-    async def get_results_from_pages(
-            self, endpoint: str, params: dict[str, Any] | None = None,
-            page_size: int = 50, limit: int | None = None
-    ) -> list[dict[str, Any]]:
-        extra_params: dict[str, Any]
-        if params is not None:
-            extra_params = params
-        else:
-            extra_params = {}
-        extra_params.update({'per_page': page_size})
+    async def send_pages(
+            self, send_channel: trio.MemorySendChannel[list[dict[str, Any]]],
+            endpoint: str, params: dict[str, Any] | None = None,
+            page_size: int = 50, limit: int | None = None,
+            cache_mode: CacheMode | None = None
+    ) -> None:
+        # Each page is read once, so caching it would only hold its raw dicts
+        # in memory for the cache's TTL
+        if cache_mode is None:
+            cache_mode = CacheMode.NONE
+        # The caller's params are copied, not mutated; only the page params
+        # change from one request to the next
+        base_params: dict[str, Any] = dict(params or {})
+        base_params['per_page'] = page_size
+        page_params: QueryPairs = []
 
-        more_pages = True
         page_num = 1
-        results: list[dict[str, Any]] = []
-
-        while more_pages:
-            logger.debug(f'Params: {extra_params}')
-            get_resp = await self.get(url=endpoint, params=extra_params)
-            results += get_resp.data
-            if get_resp.next_page_params is None:
-                more_pages = False
-            elif limit is not None and limit <= len(results):
-                more_pages = False
+        num_results = 0
+
+        async def send_page(page_data: list[dict[str, Any]]) -> bool:
+            """
+            Sends page data, sliced to the limit, if any; returns whether the
+            limit has been reached
+            """
+            nonlocal num_results
+            if limit is not None and num_results + len(page_data) > limit:
+                page_data = page_data[:limit - num_results]
+            num_results += len(page_data)
+            # Buffered send returns immediately, so the request for the
+            # next page is in flight while the consumer handles this one
+            await send_channel.send(page_data)
+            return limit is not None and limit <= num_results
+
+        url = self.resolve_url(endpoint)
+
+        async with send_channel:
+            logger.debug('Params: %s', base_params)
+            get_resp = await self.get(url=url, params=base_params,
+                                      cache_mode=cache_mode)
+            limit_reached = await send_page(get_resp.data)
+
+            if get_resp.next_page_params is None or limit_reached:
+                pass
+            elif get_resp.last_page_num is not None:
+                # The page count is known, so the rest are fetched
+                # concurrently, up to PAGE_WINDOW pages ahead of the one being
+                # sent; each page is sent once it and those before it arrive
+                page_params = [(name, value) for name, value
+                               in get_resp.next_page_params if name != 'page']
+                page_num = get_resp.last_page_num
+                if limit is not None and get_resp.data:
+                    # The server may return fewer results than per_page
+                    page_num = min(page_num, -(-limit // len(get_resp.data)))
+                pages = range(2, page_num + 1)
+                page_results: dict[int, list[dict[str, Any]]] = {}
+                page_events = {page: trio.Event() for page in pages}
+                window = trio.Semaphore(PAGE_WINDOW)
+
+                async def fetch_page(page: int) -> None:
+                    page_resp = await self.get(
+                        url=url,
+                        params=self.merge_page_params(
+                            base_params, [*page_params, ('page', str(page))]),
+                        cache_mode=cache_mode)
+                    page_results[page] = page_resp.data
+                    page_events[page].set()
+
+                async def start_fetching_pages(
+                        nursery: trio.Nursery) -> None:
+                    for page in pages:
+                        await window.acquire()
+                        nursery.start_soon(fetch_page, page)
+
+                async with trio.open_nursery() as nursery:
+                    nursery.start_soon(start_fetching_pages, nursery)
+                    for page in pages:
+                        await page_events[page].wait()
+                        window.release()
+                        if await send_page(page_results.pop(page)):
+                            break
+                    # Don't wait on pages past the limit
+                    nursery.cancel_scope.cancel()
             else:
-                extra_params.update(get_resp.next_page_params)
-                page_num += 1
+                while True:
+                    page_params = get_resp.next_page_params
+                    page_num += 1
+                    logger.debug('Params: %s', page_params)
+                    get_resp = await self.get(
+                        url=url,
+                        params=self.merge_page_params(base_params,
+                                                      page_params),
+                        cache_mode=cache_mode)
+                    limit_reached = await send_page(get_resp.data)
+                    if get_resp.next_page_params is None or limit_reached:
+                        break
+
+        logger.debug('Number of results: %d', num_results)
+        logger.debug('Number of pages: %d', page_num)
 
-        # if limit is specified, slice off data if there is more than the limit
-        if limit is not None and len(results) > limit:
-            results = results[:limit]
+    @asynccontextmanager
+    async def iter_pages(
+            self, endpoint: str, params: dict[str, Any] | None = None,
+            page_size: int = 50, limit: int | None = None,
+            cache_mode: CacheMode | None = None
+    ) -> AsyncIterator[trio.MemoryReceiveChannel[list[dict[str, Any]]]]:
+        """
+        Yields a channel of result pages, which are fetched in the background
+        one page ahead of the consumer
+        """
+        send_channel, receive_channel = trio.open_memory_channel[
+            list[dict[str, Any]]](1)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(self.send_pages, send_channel, endpoint, params,
+                               page_size, limit, cache_mode)
+            async with receive_channel:
+                yield receive_channel
+            # Stop fetching if the consumer finished early
+            nursery.cancel_scope.cancel()
+
+    async def get_results_from_pages(
+            self, endpoint: str, params: dict[str, Any] | None = None,
+            page_size: int = 50, limit: int | None = None,
+            cache_mode: CacheMode | None = None
+    ) -> list[dict[str, Any]]:
+        # Pages are already sliced to the limit; flatten them once at the end
+        chunks: list[list[dict[str, Any]]] = []
+        async with self.iter_pages(endpoint, params, page_size, limit,
+                                   cache_mode) as pages:
+            async for page in pages:
+                chunks.append(page)
+        return list(itertools.chain.from_iterable(chunks))
 
-        logger.debug(f'Number of results: {len(results)}')
-        logger.debug(f'Number of pages: {page_num}')
-        return results
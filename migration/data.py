@@ -2,23 +2,23 @@ from abc import ABC
 from dataclasses import dataclass
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class CanvasEntity(ABC):
     id: int
     name: str
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ExternalTool(CanvasEntity):
     pass
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Course(CanvasEntity):
     enrollment_term_id: int
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ExternalToolTab:
     id: str
     label: str
@@ -27,7 +27,7 @@ class ExternalToolTab:
     position: int
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ToolMigration:
     source_id: int
     target_id: int
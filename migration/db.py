@@ -3,6 +3,7 @@ from typing import TypedDict
 from urllib.parse import quote_plus
 
 import sqlalchemy
+from sqlalchemy.pool import NullPool
 
 
 class Dialect(Enum):
@@ -24,8 +25,10 @@ class DB:
     def __init__(self, dialect: Dialect, params: DBParams):
         params['password'] = quote_plus(params['password'])
         core_string = '{user}:{password}@{host}:{port}/{name}'.format(**params)
+        # A run only ever holds one connection, so skip pooling
         self.engine = sqlalchemy.create_engine(
-            f'{dialect.value}://{core_string}')
+            f'{dialect.value}://{core_string}', poolclass=NullPool)
+        self.connection = None
 
     def get_connection(self) -> sqlalchemy.engine.Connection:
         if self.connection is None:
@@ -1,17 +1,17 @@
-class BaseException(Exception):
+class ToolMigrationError(Exception):
     """
     Base class for exceptions for the project
     """
 
 
-class InvalidToolIdsException(BaseException):
+class InvalidToolIdsException(ToolMigrationError):
     """
     Exception raised when one or more tool ID that are referenced are not
     found in an account or course context
     """
 
 
-class ConfigException(BaseException):
+class ConfigException(ToolMigrationError):
     """
     Exception raised when an environment variable value is invalid
     """
@@ -1,5 +1,6 @@
 import logging
 import os
+from collections import Counter
 from contextlib import nullcontext
 from io import StringIO
 
@@ -7,12 +8,12 @@ import trio
 from dotenv import load_dotenv
 from tqdm import tqdm
 
-from api import API
-from data import Course, ExternalTool, ToolMigration
+from api import API, MAX_ASYNC_CONNS
+from data import Course, ExternalTool, ExternalToolTab, ToolMigration
 from db import DB, Dialect
-from exceptions import InvalidToolIdsException
-from manager import AccountManagerFactory, CourseManager
-from utils import convert_csv_to_int_list, find_entity_by_id, time_execution
+from exceptions import ConfigException, InvalidToolIdsException
+from manager import CourseManager, make_account_manager
+from utils import build_entity_index, convert_csv_to_int_list, time_execution
 
 summaryLogBuffer = StringIO()
 summaryLogHandler = logging.StreamHandler(summaryLogBuffer)
@@ -26,6 +27,10 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+PROGRESS_MIN_INTERVAL = 0.5
+
+CourseTabs = tuple[CourseManager, list[ExternalToolTab]]
+
 
 class tqdmLogging(tqdm):
     """
@@ -42,96 +47,206 @@ class tqdmLogging(tqdm):
         return logStatus
 
 
-class TrioProgress(trio.abc.Instrument):
-    def __init__(self,
-                 total, **kwargs):
-        self.tqdm = tqdmLogging(total=total, mininterval=None,
-                                leave=False, **kwargs)
-
-    def task_exited(self, task):
-        if task.name.endswith('migrate_tool_for_course'):
-            self.tqdm.update(1)
-
-
 def find_tools_for_migrations(
         tools: list[ExternalTool], migrations: list[ToolMigration]
 ) -> list[tuple[ExternalTool, ExternalTool]]:
-    tool_pairs: list[tuple[ExternalTool, ExternalTool]] = []
-    for migration in migrations:
-        source_tool = find_entity_by_id(migration.source_id, tools)
-        target_tool = find_entity_by_id(migration.target_id, tools)
-        if source_tool is None or target_tool is None:
-            invalid_tool_ids = []
-            if source_tool is None:
-                invalid_tool_ids.append(migration.source_id)
-            if target_tool is None:
-                invalid_tool_ids.append(migration.target_id)
-            raise InvalidToolIdsException(
-                'The following tool IDs from one of your migrations '
-                'were not found in the account: ' +
-                str(invalid_tool_ids))
-        tool_pairs.append((source_tool, target_tool))
-    return tool_pairs
-
-
-async def migrate_tool_for_course(api: API, course: Course,
-                                  source_tool: ExternalTool,
-                                  target_tool: ExternalTool):
-    course_manager = CourseManager(course, api)
-    tabs = await course_manager.get_tool_tabs()
-    source_tool_tab = CourseManager.find_tab_by_tool_id(source_tool.id, tabs)
-    target_tool_tab = CourseManager.find_tab_by_tool_id(target_tool.id, tabs)
-    if source_tool_tab is None or target_tool_tab is None:
+    tools_by_id = build_entity_index(tools)
+    # Check every migration first so all of the bad IDs are reported at once
+    invalid_tool_ids = list(dict.fromkeys(
+        tool_id
+        for migration in migrations
+        for tool_id in (migration.source_id, migration.target_id)
+        if tool_id not in tools_by_id))
+    if invalid_tool_ids:
         raise InvalidToolIdsException(
-            'One or both of the following tool IDs are not available in '
-            'this course: ' +
-            str([source_tool.id, target_tool.id]))
-    await course_manager.replace_tool_tab(source_tool_tab, target_tool_tab)
+            'The following tool IDs from your migrations '
+            'were not found in the account: ' +
+            str(invalid_tool_ids))
+    return [
+        (tools_by_id[migration.source_id], tools_by_id[migration.target_id])
+        for migration in migrations
+    ]
+
+
+async def fetch_tabs_for_courses(
+        api: API, receive_channel: trio.MemoryReceiveChannel[Course],
+        send_channel: trio.MemorySendChannel[CourseTabs], tool_ids: set[int]):
+    async with receive_channel, send_channel:
+        async for course in receive_channel:
+            course_manager = CourseManager(course, api)
+            tabs = await course_manager.get_tool_tabs(tool_ids)
+            await send_channel.send((course_manager, tabs))
+
+
+async def migrate_tools_for_course(
+        course_manager: CourseManager, tabs: list[ExternalToolTab],
+        tool_pairs: list[tuple[ExternalTool, ExternalTool]]) -> bool:
+    """
+    Applies every migration to the course's tabs in order, so a later
+    migration sees the tabs updated by earlier ones; returns whether any tab
+    was changed
+    """
+    is_changed = False
+    tabs_by_tool_id = {tab.tool_id: tab for tab in tabs}
+    for source_tool, target_tool in tool_pairs:
+        source_tool_tab = tabs_by_tool_id.get(source_tool.id)
+        target_tool_tab = tabs_by_tool_id.get(target_tool.id)
+        if source_tool_tab is None or target_tool_tab is None:
+            # Skip only this migration, rather than cancelling every course
+            logger.warning(course_manager.create_course_log_message(
+                'Skipping migration; one or both of the following tool IDs '
+                'are not available in this course: '
+                f'{[source_tool.id, target_tool.id]}'))
+            continue
+        for new_tab in await course_manager.replace_tool_tab(
+                source_tool_tab, target_tool_tab):
+            if new_tab is not None:
+                is_changed |= new_tab != tabs_by_tool_id[new_tab.tool_id]
+                tabs_by_tool_id[new_tab.tool_id] = new_tab
+    return is_changed
+
+
+async def migrate_tools_for_courses(
+        receive_channel: trio.MemoryReceiveChannel[CourseTabs],
+        tool_pairs: list[tuple[ExternalTool, ExternalTool]], progress: tqdm,
+        course_counts: Counter[str]):
+    async with receive_channel:
+        async for course_manager, tabs in receive_channel:
+            is_changed = await migrate_tools_for_course(
+                course_manager, tabs, tool_pairs)
+            course_counts['changed' if is_changed else 'unchanged'] += 1
+            progress.update(1)
+
+
+async def fetch_and_migrate_tools_for_courses(
+        api: API, receive_channel: trio.MemoryReceiveChannel[Course],
+        tool_ids: set[int],
+        tool_pairs: list[tuple[ExternalTool, ExternalTool]], progress: tqdm,
+        course_counts: Counter[str]):
+    """
+    Fetches and then updates each course's tabs in turn, for a run allowed
+    too few courses at once to split them between the pipeline's two pools
+    """
+    async with receive_channel:
+        async for course in receive_channel:
+            course_manager = CourseManager(course, api)
+            tabs = await course_manager.get_tool_tabs(tool_ids)
+            is_changed = await migrate_tools_for_course(
+                course_manager, tabs, tool_pairs)
+            course_counts['changed' if is_changed else 'unchanged'] += 1
+            progress.update(1)
 
 
 @time_execution
 async def main(api: API, account_id: int, term_ids: list[int],
-               migrations: list[ToolMigration], db: DB | None = None):
-    factory = AccountManagerFactory()
-    account_manager = factory.get_manager(account_id, api, db)
-
-    async with api.client:
-        with db if db is not None else nullcontext():  # type: ignore
+               migrations: list[ToolMigration], db: DB | None = None,
+               max_concurrent_courses: int = MAX_ASYNC_CONNS):
+    account_manager = make_account_manager(account_id, api, db)
+    # Repeated migrations would only redo the same work, so keep the first
+    migrations = list(dict.fromkeys(migrations))
+
+    with db if db is not None else nullcontext():  # type: ignore
+        tool_ids = ({migration.source_id for migration in migrations} |
+                    {migration.target_id for migration in migrations})
+        tools: list[ExternalTool] = []
+
+        async def log_account_name():
             account_name = await account_manager.get_name()
-            logger.info(f'Account ({account_id}) name: {repr(account_name)}')
-
-            # term_names = await account_manager.get_term_names(term_ids)
-            logger.info(f'Term names… (temporarily disabled; see issue #40)')
-            # for term_id in term_ids:
-            #     logger.info(f'  Term ({term_id}): {repr(term_names[term_id])}')
-
-            tools = await account_manager.get_tools_installed_in_account()
-            logger.info(
-                'Number of tools found in account'
-                f' ({account_id}): {len(tools)}')
-
+            logger.info('Account (%s) name: %r', account_id, account_name)
+
+        async def get_tools():
+            nonlocal tools
+            tools = await account_manager.get_tools_by_ids(tool_ids)
+
+        # The account name and the tools don't depend on each other
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(log_account_name)
+            nursery.start_soon(get_tools)
+
+        # term_names = await account_manager.get_term_names(term_ids)
+        logger.info('Term names… (temporarily disabled; see issue #40)')
+        # for term_id in term_ids:
+        #     logger.info(f'  Term ({term_id}): {repr(term_names[term_id])}')
+
+        # Validate the migrations' tools before fetching anything expensive
+        tool_pairs = find_tools_for_migrations(tools, migrations)
+        # The full tool list is only fetched at DEBUG, so count what was found
+        logger.info('Number of tools found in account (%s) for %d '
+                    'migration(s): %d', account_id, len(tool_pairs),
+                    len(tools))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            all_tools = await account_manager.get_tools_installed_in_account()
+            logger.debug('Number of tools found in account (%s): %d',
+                         account_id, len(all_tools))
             logger.debug('Tools…\n\t' +
-                         '\n\t'.join([str(tool) for tool in tools]))
-
-            tool_pairs = find_tools_for_migrations(tools, migrations)
-
-            # get list of tools available in account
-            courses = await account_manager.get_courses_in_terms(term_ids)
-            logger.info(
-                f'Number of courses found in account ({account_id}) '
-                f'for terms {term_ids}: {len(courses)}')
-
-            for source_tool, target_tool in tool_pairs:
-                logger.info(f'Source tool: {source_tool}')
-                logger.info(f'Target tool: {target_tool}')
-
-                progress = TrioProgress(total=len(courses), unit='courses')
-                trio.lowlevel.add_instrument(progress)
-                async with trio.open_nursery() as nursery:
-                    for course in courses:
-                        nursery.start_soon(migrate_tool_for_course, api,
-                                           course, source_tool, target_tool)
-                trio.lowlevel.remove_instrument(progress)
+                         '\n\t'.join([str(tool) for tool in all_tools]))
+
+        # get list of tools available in account
+        courses = await account_manager.get_courses_in_terms(term_ids)
+        logger.info('Number of courses found in account (%s) '
+                    'for terms %s: %d', account_id, term_ids, len(courses))
+
+        for source_tool, target_tool in tool_pairs:
+            logger.info('Source tool: %s', source_tool)
+            logger.info('Target tool: %s', target_tool)
+
+        # Each refresh is a log record, so limit how often they're made
+        progress = tqdmLogging(total=len(courses),
+                               mininterval=PROGRESS_MIN_INTERVAL,
+                               leave=False, unit='courses')
+        course_counts: Counter[str] = Counter()
+        send_channel, receive_channel = trio.open_memory_channel[Course](
+            len(courses))
+        async with send_channel:
+            for course in courses:
+                send_channel.send_nowait(course)
+
+        # Two pools of workers form a pipeline: one fetches courses' tabs
+        # while the other updates the tabs already fetched.  They split
+        # max_concurrent_courses between them, and the unbuffered channel
+        # hands each course over without queueing it, so no more than that
+        # many courses are in progress at once.  A pipeline needs at least
+        # two workers, so a limit of one gets a single worker doing both.
+        async with trio.open_nursery() as nursery:
+            if max_concurrent_courses < 2:
+                nursery.start_soon(
+                    fetch_and_migrate_tools_for_courses, api, receive_channel,
+                    tool_ids, tool_pairs, progress, course_counts)
+            else:
+                num_fetchers = max_concurrent_courses // 2
+                num_migrators = max_concurrent_courses - num_fetchers
+                tabs_send_channel, tabs_receive_channel = \
+                    trio.open_memory_channel[CourseTabs](0)
+                async with receive_channel, tabs_send_channel, \
+                        tabs_receive_channel:
+                    for _ in range(num_fetchers):
+                        nursery.start_soon(
+                            fetch_tabs_for_courses, api,
+                            receive_channel.clone(),
+                            tabs_send_channel.clone(), tool_ids)
+                    for _ in range(num_migrators):
+                        nursery.start_soon(
+                            migrate_tools_for_courses,
+                            tabs_receive_channel.clone(), tool_pairs,
+                            progress, course_counts)
+        progress.close()
+        logger.info('Courses changed: %d; already migrated or skipped: %d',
+                    course_counts['changed'], course_counts['unchanged'])
+
+
+async def run_with_api(api_url: str, api_key: str, account_id: int,
+                       term_ids: list[int], migrations: list[ToolMigration],
+                       db: DB | None = None,
+                       max_concurrent_courses: int = MAX_ASYNC_CONNS,
+                       http2: bool = True):
+    # One connection per course in progress, so no worker waits on the pool
+    api = API(api_url, api_key, max_connections=max_concurrent_courses,
+              http2=http2)
+    # The client's connections belong to this trio run, so close them in it
+    async with api.client:
+        await main(api, account_id, term_ids, migrations, db,
+                   max_concurrent_courses)
 
 
 def run():
@@ -142,34 +257,35 @@ def run():
     env_file_name: str = os.path.join(root_dir, 'env')
 
     if os.path.exists(env_file_name):
-        logger.info(f'Setting environment from file {repr(env_file_name)}.')
+        logger.info('Setting environment from file %r.', env_file_name)
         load_dotenv(env_file_name, verbose=True)
     else:
-        logger.info(f'File {repr(env_file_name)} not found.  '
-                    'Using existing environment.')
+        logger.info('File %r not found.  Using existing environment.',
+                    env_file_name)
 
     logger.info('Parameters from environment…')
 
     # Set up logging
     log_level_default = logging.INFO
     log_level = os.getenv('LOG_LEVEL', log_level_default)
-    logger.info(f'  LOG_LEVEL: {repr(log_level)} '
-                f'({repr(logging.getLevelName(log_level))})')
+    logger.info('  LOG_LEVEL: %r (%r)',
+                log_level, logging.getLevelName(log_level))
     if log_level == '':
         log_level = log_level_default
-        logger.info(f'  Using default LOG_LEVEL: {repr(log_level)} '
-                    f'({repr(logging.getLevelName(log_level))})')
+        logger.info('  Using default LOG_LEVEL: %r (%r)',
+                    log_level, logging.getLevelName(log_level))
 
     http_log_level_default = logging.WARNING
     http_log_level = os.getenv('HTTP_LOG_LEVEL', http_log_level_default)
-    logger.info(f'  HTTP_LOG_LEVEL: {repr(http_log_level)} '
-                f'({repr(logging.getLevelName(http_log_level))})')
+    logger.info('  HTTP_LOG_LEVEL: %r (%r)',
+                http_log_level, logging.getLevelName(http_log_level))
     if http_log_level == '':
         http_log_level = http_log_level_default
-        logger.info(f'  Using default HTTP_LOG_LEVEL: {repr(http_log_level)} '
-                    f'({repr(logging.getLevelName(http_log_level))})')
+        logger.info('  Using default HTTP_LOG_LEVEL: %r (%r)',
+                    http_log_level, logging.getLevelName(http_log_level))
 
-    logging.basicConfig(level=log_level)
+    # The root logger was configured at import, so only its level changes
+    logging.getLogger().setLevel(log_level)
 
     httpx_logger = logging.getLogger('httpx')
     httpx_logger.setLevel(http_log_level)
@@ -177,43 +293,56 @@ def run():
     httpcore_logger.setLevel(http_log_level)
 
     api_url: str = os.getenv('API_URL', '')
-    logger.info(f'  API_URL: {repr(api_url)}')
+    logger.info('  API_URL: %r', api_url)
 
     api_key: str = os.getenv('API_KEY', '')
-    logger.info(f'  API_KEY: *REDACTED*')
+    logger.info('  API_KEY: *REDACTED*')
 
     account_id: int = int(os.getenv('ACCOUNT_ID', 0))
-    logger.info(f'  ACCOUNT_ID: ({account_id})')
+    logger.info('  ACCOUNT_ID: (%s)', account_id)
 
     enrollment_term_ids: list[int] = convert_csv_to_int_list(
         os.getenv('ENROLLMENT_TERM_IDS_CSV', '0'))
-    logger.info(f'  ENROLLMENT_TERM_IDS_CSV: {enrollment_term_ids}')
+    logger.info('  ENROLLMENT_TERM_IDS_CSV: %s', enrollment_term_ids)
 
     source_tool_id: int = int(os.getenv('SOURCE_TOOL_ID', 0))
-    logger.info(f'  SOURCE_TOOL_ID: ({source_tool_id})')
+    logger.info('  SOURCE_TOOL_ID: (%s)', source_tool_id)
 
     target_tool_id: int = int(os.getenv('TARGET_TOOL_ID', 0))
-    logger.info(f'  TARGET_TOOL_ID: ({target_tool_id})')
+    logger.info('  TARGET_TOOL_ID: (%s)', target_tool_id)
+
+    max_concurrent_courses: int = int(
+        os.getenv('MAX_CONCURRENT_COURSES', MAX_ASYNC_CONNS))
+    logger.info('  MAX_CONCURRENT_COURSES: (%s)', max_concurrent_courses)
+    if max_concurrent_courses < 1:
+        # A pool of no connections would leave every request waiting on it
+        exception = ConfigException()
+        exception.add_note('MAX_CONCURRENT_COURSES must be at least 1')
+        raise exception
+
+    http2_disabled_param = os.getenv('HTTP2_DISABLED', 'false')
+    http2_disabled = http2_disabled_param.lower() in ('true', 'yes', '1')
+    logger.info('  HTTP2_DISABLED: %r (%r)',
+                http2_disabled_param, http2_disabled)
 
     wh_host = os.getenv('WH_HOST')
-    logger.info(f'  WH_HOST: {repr(wh_host)}')
+    logger.info('  WH_HOST: %r', wh_host)
 
     wh_port = os.getenv('WH_PORT')
-    logger.info(f'  WH_PORT: {repr(wh_port)}')
+    logger.info('  WH_PORT: %r', wh_port)
 
     wh_name = os.getenv('WH_NAME')
-    logger.info(f'  WH_NAME: {repr(wh_name)}')
+    logger.info('  WH_NAME: %r', wh_name)
 
     wh_user = os.getenv('WH_USER')
-    logger.info(f'  WH_USER: {repr(wh_user)}')
+    logger.info('  WH_USER: %r', wh_user)
 
     wh_password = os.getenv('WH_PASSWORD')
-    logger.info(f'  WH_PASSWORD: *REDACTED*')
+    logger.info('  WH_PASSWORD: *REDACTED*')
 
     wh_disabled_param = os.getenv('WH_DISABLED', 'false')
     wh_disabled = wh_disabled_param.lower() in ('true', 'yes', '1')
-    logger.info(f'  WH_DISABLED: {repr(wh_disabled_param)} '
-                f'({repr(wh_disabled)})')
+    logger.info('  WH_DISABLED: %r (%r)', wh_disabled_param, wh_disabled)
 
     db: DB | None = None
     if (
@@ -239,10 +368,11 @@ def run():
                        'configured, so falling back to only using the '
                        'Canvas API…')
 
-    trio.run(main, API(api_url, api_key), account_id,
+    trio.run(run_with_api, api_url, api_key, account_id,
              enrollment_term_ids, [
                  ToolMigration(source_id=source_tool_id,
-                               target_id=target_tool_id)], db)
+                               target_id=target_tool_id)], db,
+             max_concurrent_courses, not http2_disabled)
 
     summaryLogHandler.flush()
     summaryLogBuffer.flush()
@@ -1,48 +1,58 @@
 import logging
-from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
-from typing import Any, Dict
+from typing import Any, Dict, Protocol
 
+import httpx
 import sqlalchemy
+import trio
 
-from api import API
+from api import API, CacheMode
 from data import Course, ExternalTool, ExternalToolTab
 from db import DB
-from utils import chunk_integer, time_execution
+from utils import chunk_integer, disk_cache, time_execution
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
-class AccountManagerBase(ABC):
+class AccountManagerBase(Protocol):
     account_id: int
 
-    @abstractmethod
     async def get_name(self) -> str:
-        pass
+        ...
 
-    @abstractmethod
     async def get_term_names(self, term_ids: list[int]) -> Dict[int, str]:
-        pass
+        ...
 
-    @abstractmethod
     async def get_tools_installed_in_account(self) -> list[ExternalTool]:
-        pass
+        ...
+
+    async def get_tools_by_ids(self, tool_ids: set[int]) -> list[ExternalTool]:
+        ...
 
-    @abstractmethod
     async def get_courses_in_terms(self, term_ids: list[int],
                                    limit: int | None = None) -> list[Course]:
-        pass
+        ...
 
 
 @dataclass
-class AccountManager(AccountManagerBase):
+class AccountManager:
+    account_id: int
     api: API
+    tools: list[ExternalTool] | None = field(
+        default=None, init=False, repr=False)
+    tools_lock: trio.Lock = field(
+        default_factory=trio.Lock, init=False, repr=False)
+
+    def get_cache_key(self, name: str, *parts: Any) -> str:
+        return '_'.join([name, self.api.client.base_url.host,
+                         str(self.account_id), *map(str, parts)])
 
+    @disk_cache(lambda self: self.get_cache_key('name'))
     async def get_name(self) -> str:
         result = await self.api.get(f'/accounts/{self.account_id}')
         return result.data['name']
 
+    @disk_cache(lambda self, term_ids: self.get_cache_key('terms', *term_ids))
     async def get_term_names(self, term_ids: list[int]) -> Dict[int, str]:
         results = await self.api.get(f'/accounts/1/terms')
         term_names = {
@@ -52,44 +62,115 @@ class AccountManager(AccountManagerBase):
         return term_names
 
     async def get_tools_installed_in_account(self) -> list[ExternalTool]:
+        """
+        Fetches the account's tools once; concurrent and later callers
+        share the result
+        """
+        async with self.tools_lock:
+            if self.tools is None:
+                self.tools = await self.fetch_tools_installed_in_account()
+        return self.tools
+
+    def invalidate_tools(self) -> None:
+        """
+        Forgets the fetched tools, so the next call fetches them again
+        """
+        self.tools = None
+
+    @disk_cache(lambda self: self.get_cache_key('tools'))
+    async def fetch_tools_installed_in_account(self) -> list[ExternalTool]:
         params = {'include_parents': True}
-        results = await self.api.get_results_from_pages(
-            f'/accounts/{self.account_id}/external_tools', params)
-        tools = [ExternalTool(id=tool_dict['id'], name=tool_dict['name']) for
-                 tool_dict in results]
+        tools: list[ExternalTool] = []
+        async with self.api.iter_pages(
+                f'/accounts/{self.account_id}/external_tools', params
+        ) as pages:
+            async for batch in pages:
+                tools += [
+                    ExternalTool(id=tool_dict['id'], name=tool_dict['name'])
+                    for tool_dict in batch
+                ]
+        return tools
+
+    async def get_tool(self, tool_id: int) -> ExternalTool | None:
+        try:
+            result = await self.api.get(
+                f'/accounts/{self.account_id}/external_tools/{tool_id}')
+        except httpx.HTTPStatusError as error:
+            if error.response.status_code == httpx.codes.NOT_FOUND:
+                return None
+            raise
+        return ExternalTool(id=result.data['id'], name=result.data['name'])
+
+    async def get_tools_by_ids(self, tool_ids: set[int]) -> list[ExternalTool]:
+        """
+        Looks up each tool directly and concurrently.  Tools not found that
+        way (e.g., installed in a parent account) are searched for in the
+        full list of tools available in the account.
+        """
+        tools: list[ExternalTool] = []
+
+        async def find_tool(tool_id: int):
+            tool = await self.get_tool(tool_id)
+            if tool is not None:
+                tools.append(tool)
+
+        async with trio.open_nursery() as nursery:
+            for tool_id in tool_ids:
+                nursery.start_soon(find_tool, tool_id)
+
+        if len(tools) < len(tool_ids):
+            tools = [tool for tool in
+                     await self.get_tools_installed_in_account()
+                     if tool.id in tool_ids]
         return tools
 
     @time_execution
+    @disk_cache(lambda self, term_ids, limit=None: self.get_cache_key(
+        'courses', *term_ids, f'limit{limit}'))
     async def get_courses_in_terms(self, term_ids: list[int],
                                    limit: int | None = None) -> list[Course]:
         limit_chunks = None
         if limit is not None:
             limit_chunks = chunk_integer(limit, len(term_ids))
 
-        results: list[dict[str, Any]] = []
-        for i, term_id in enumerate(term_ids):
+        courses_by_term: list[list[Course]] = [[] for _ in term_ids]
+
+        async def get_courses_in_term(i: int, term_id: int):
             limit_for_term = limit_chunks[
                 i] if limit_chunks is not None else None
-            term_results = await self.api.get_results_from_pages(
-                f'/accounts/{self.account_id}/courses',
-                params={'enrollment_term_id': term_id},
-                page_size=50,
-                limit=limit_for_term
-            )
-            results += term_results
-        courses = [
-            Course(
-                id=course_dict['id'],
-                name=course_dict['name'],
-                enrollment_term_id=course_dict['enrollment_term_id']
-            )
-            for course_dict in results
-        ]
+            async with self.api.iter_pages(
+                    f'/accounts/{self.account_id}/courses',
+                    params={'enrollment_term_id': term_id},
+                    page_size=50,
+                    limit=limit_for_term
+            ) as pages:
+                async for batch in pages:
+                    courses_by_term[i] += [
+                        Course(
+                            id=course_dict['id'],
+                            name=course_dict['name'],
+                            enrollment_term_id=course_dict[
+                                'enrollment_term_id']
+                        )
+                        for course_dict in batch
+                    ]
+
+        async with trio.open_nursery() as nursery:
+            for i, term_id in enumerate(term_ids):
+                nursery.start_soon(get_courses_in_term, i, term_id)
+
+        # Deduplicate by ID (e.g., if a term ID was given twice)
+        courses = list({
+            course.id: course
+            for term_courses in courses_by_term
+            for course in term_courses
+        }.values())
         return courses
 
 
 @dataclass
-class WarehouseAccountManager(AccountManagerBase):
+class WarehouseAccountManager:
+    account_id: int
     db: DB
     api: API
     account_manager: AccountManager = field(init=False)
@@ -106,6 +187,9 @@ class WarehouseAccountManager(AccountManagerBase):
     async def get_tools_installed_in_account(self) -> list[ExternalTool]:
         return await self.account_manager.get_tools_installed_in_account()
 
+    async def get_tools_by_ids(self, tool_ids: set[int]) -> list[ExternalTool]:
+        return await self.account_manager.get_tools_by_ids(tool_ids)
+
     async def get_subaccount_ids(self) -> list[int]:
         results = await self.api.get_results_from_pages(
             f'/accounts/{self.account_id}/sub_accounts',
@@ -144,64 +228,94 @@ class WarehouseAccountManager(AccountManagerBase):
                                  expanding=True),
             **extra_bind_params
         )
-        results = conn.execute(statement).all()
+        # Stream rows from a server-side cursor rather than buffering them all
+        results = conn.execution_options(stream_results=True).execute(
+            statement)
 
-        courses = []
-        for result in results:
-            result_dict = result._asdict()
-            courses.append(Course(
-                id=int(result_dict['course_id']),
-                name=result_dict['course_name'],
-                enrollment_term_id=int(result_dict['term_id'])
-            ))
+        courses = [
+            Course(id=int(course_id), name=course_name,
+                   enrollment_term_id=int(term_id))
+            for course_id, course_name, term_id in results
+        ]
         return courses
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class CourseManager:
     id_prefix = 'context_external_tool_'
+    id_prefix_len = len(id_prefix)
     course: Course
     api: API
 
     @staticmethod
     def find_tab_by_tool_id(tool_id: int, tabs: list[
         ExternalToolTab]) -> ExternalToolTab | None:
+        return CourseManager.find_tabs_by_tool_ids({tool_id}, tabs).get(tool_id)
+
+    @staticmethod
+    def find_tabs_by_tool_ids(
+            tool_ids: set[int], tabs: list[ExternalToolTab]
+    ) -> dict[int, ExternalToolTab]:
+        found_tabs: dict[int, ExternalToolTab] = {}
         for tab in tabs:
-            if tab.tool_id == tool_id:
-                return tab
-        return None
+            if tab.tool_id in tool_ids:
+                found_tabs[tab.tool_id] = tab
+                if len(found_tabs) == len(tool_ids):
+                    break
+        return found_tabs
 
     @classmethod
-    def convert_data_to_tool_tab(cls, data: dict[str, Any]) -> ExternalToolTab:
+    def convert_data_to_tool_tab(
+            cls, data: dict[str, Any], tool_id: int | None = None
+    ) -> ExternalToolTab:
         if data is not None:
-            tool_id = int(data['id'].replace(cls.id_prefix, ''))
+            tab_id = data['id']
+            if tool_id is None:
+                tool_id = int(tab_id[cls.id_prefix_len:])
             return ExternalToolTab(
-                id=data['id'],
+                id=tab_id,
                 label=data['label'],
                 tool_id=tool_id,
-                is_hidden=('hidden' in data.keys() and data['hidden'] is True),
+                is_hidden=data.get('hidden') is True,
                 position=data['position']
             )
 
     def create_course_log_message(self, message: str) -> str:
         return f'{self.course} | {message}'
 
-    async def get_tool_tabs(self) -> list[ExternalToolTab]:
+    async def get_tool_tabs(
+            self, tool_ids: set[int] | None = None
+    ) -> list[ExternalToolTab]:
+        """
+        Returns the course's external tool tabs, limited to the given tools'
+        tabs if tool IDs are given
+        """
+        # Tabs change as the migration updates them, so always fetch fresh
         results = await self.api.get_results_from_pages(
-            f'/courses/{self.course.id}/tabs')
+            f'/courses/{self.course.id}/tabs', cache_mode=CacheMode.NONE)
 
         tabs: list[ExternalToolTab] = []
+        is_debug_enabled = logger.isEnabledFor(logging.DEBUG)
         for result in results:
-            logger.debug(result)
-            if result['type'] == 'external':
-                tabs.append(CourseManager.convert_data_to_tool_tab(result))
+            if is_debug_enabled:
+                logger.debug(result)
+            if result['type'] != 'external':
+                continue
+            # Parsed once, for both the filter and the tab
+            tool_id = int(result['id'][self.id_prefix_len:])
+            if tool_ids is not None and tool_id not in tool_ids:
+                continue
+            tabs.append(
+                CourseManager.convert_data_to_tool_tab(result, tool_id))
         return tabs
 
     async def update_tool_tab(self, tab: ExternalToolTab, is_hidden: bool,
                               position: int | None = None):
-        params: dict[str, Any] = {'hidden': is_hidden}
+        # Pairs of strings are passed to httpx as is, without conversion
+        params: tuple[tuple[str, str], ...] = (
+            ('hidden', 'true' if is_hidden else 'false'),)
         if position is not None:
-            params.update({'position': position})
+            params += (('position', str(position)),)
 
         result = await self.api.put(
             f'/courses/{self.course.id}/tabs/{tab.id}',
@@ -212,36 +326,50 @@ class CourseManager:
 
     async def replace_tool_tab(
             self, source_tab: ExternalToolTab, target_tab: ExternalToolTab
-    ) -> tuple[ExternalToolTab, ExternalToolTab]:
-        logger.debug([source_tab, target_tab])
+    ) -> tuple[ExternalToolTab | None, ExternalToolTab | None]:
+        is_debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        if is_debug_enabled:
+            logger.debug([source_tab, target_tab])
 
         # Source tool is hidden in course, don't do anything
         if source_tab.is_hidden:
-            logger.debug(self.create_course_log_message(
-                f'Skipping replacement for {[source_tab, target_tab]}; '
-                'source tool is hidden.'
-            ))
+            if is_debug_enabled:
+                logger.debug(self.create_course_log_message(
+                    f'Skipping replacement for {[source_tab, target_tab]}; '
+                    'source tool is hidden.'
+                ))
             return (source_tab, target_tab)
         else:
+            new_target_tab: ExternalToolTab | None
             if not target_tab.is_hidden:
                 logger.warning(self.create_course_log_message(
                     f'Both tools ({[source_tab, target_tab]}) are currently '
                     'available.  Rolling back will hide the target tool!'
                 ))
-                logger.debug(self.create_course_log_message(
-                    f'Skipping update for {target_tab}; '
-                    'tool is already available.'
-                ))
+                if is_debug_enabled:
+                    logger.debug(self.create_course_log_message(
+                        f'Skipping update for {target_tab}; '
+                        'tool is already available.'
+                    ))
                 new_target_tab = target_tab
             else:
+                # Show the target before hiding the source, one at a time, so
+                # the two position changes can't interleave
                 target_position = source_tab.position
                 new_target_tab = await self.update_tool_tab(
                     tab=target_tab, is_hidden=False, position=target_position)
-                if new_target_tab is not None:
-                    logger.info(self.create_course_log_message(
-                        'Made available target tool in course navigation: '
-                        f'{new_target_tab}'
+                if new_target_tab is None:
+                    # Canvas rejected the update (API.put logged it), so keep
+                    # the source rather than leave the course with neither tool
+                    logger.warning(self.create_course_log_message(
+                        f'Keeping source tool {source_tab} available; '
+                        f'target tool {target_tab} could not be shown.'
                     ))
+                    return (source_tab, None)
+                logger.info(self.create_course_log_message(
+                    'Made available target tool in course navigation: '
+                    f'{new_target_tab}'
+                ))
 
             # Always hide the source tool if it's available
             new_source_tab = await self.update_tool_tab(tab=source_tab,
@@ -254,11 +382,9 @@ class CourseManager:
             return (new_source_tab, new_target_tab)
 
 
-class AccountManagerFactory:
-
-    def get_manager(self, account_id: int, api: API,
-                    db: DB | None) -> AccountManagerBase:
-        if db is not None:
-            return WarehouseAccountManager(account_id, db, api)
-        else:
-            return AccountManager(account_id, api)
+def make_account_manager(account_id: int, api: API,
+                         db: DB | None) -> AccountManagerBase:
+    if db is not None:
+        return WarehouseAccountManager(account_id, db, api)
+    else:
+        return AccountManager(account_id, api)
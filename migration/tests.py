@@ -1,57 +1,257 @@
+import functools
+import hashlib
+import inspect
 import json
 import logging
 import os
 import re
+import tempfile
 import time
 import unittest
-from unittest.mock import MagicMock, patch
+from collections import Counter
+from typing import Any, Awaitable, Callable
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import httpx
 import trio
 from dotenv import load_dotenv
 
+from api import PAGE_WINDOW, CacheMode
 from data import Course, ExternalTool, ExternalToolTab, ToolMigration
 from db import DB, DBParams, Dialect
 from exceptions import ConfigException, InvalidToolIdsException
-from main import main, find_tools_for_migrations
+from main import main, find_tools_for_migrations, run
 from manager import API, AccountManager, CourseManager, WarehouseAccountManager
-from utils import convert_csv_to_int_list, chunk_integer, find_entity_by_id, \
-    time_execution
+from utils import build_entity_index, convert_csv_to_int_list, \
+    chunk_integer, disk_cache, find_entity_by_id, time_execution
 
 logger = logging.getLogger(__name__)
 
 
-class APITestCase(unittest.IsolatedAsyncioTestCase):
+def setUpModule():
+    # Loaded here rather than under __main__ so that runs through
+    # `python -m unittest` see the integration settings too
+    root_dir: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    load_dotenv(os.path.join(root_dir, '.env'), verbose=True)
+
+
+def run_with_trio(method: Callable[..., Awaitable[None]]) -> Callable:
+    """
+    Wraps a coroutine test method so unittest can call it, running it in a
+    trio.run of its own
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        trio.run(functools.partial(method, self, *args, **kwargs))
+
+    return wrapper
+
+
+class TrioTestCase(unittest.TestCase):
+    """
+    Base class for tests with coroutine methods, which are run with trio
+    because the API and managers depend on it.  Subclasses that override
+    setUp must call super().setUp() for asyncSetUp to run.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name, value in list(vars(cls).items()):
+            if name.startswith('test') and inspect.iscoroutinefunction(value):
+                setattr(cls, name, run_with_trio(value))
+
+    async def asyncSetUp(self) -> None:
+        pass
+
+    def setUp(self) -> None:
+        trio.run(self.asyncSetUp)
+
+
+TEST_API_URL = 'https://canvas.test'
+TEST_API_KEY = 'test-key'
+TEST_ACCOUNT_ID = 1
+TEST_TERM_IDS = [1, 2]
+TEST_SOURCE_TOOL_ID = 1
+TEST_TARGET_TOOL_ID = 2
+TEST_TOOLS = [
+    {'id': tool_id, 'name': f'Test Tool {tool_id}'} for tool_id in range(1, 4)
+]
+TEST_COURSES = [
+    {
+        'id': 100 + i,
+        'name': f'Test Course {i}',
+        'enrollment_term_id': TEST_TERM_IDS[i % len(TEST_TERM_IDS)]
+    }
+    for i in range(12)
+]
+TEST_COURSE_DATA = [{'name': 'Test Course'}]
+# Kept as bytes so it can be truncated to simulate malformed JSON
+TEST_COURSE_BODY = json.dumps(TEST_COURSE_DATA).encode()
+TEST_TABS = [
+    {'id': 'home', 'label': 'Home', 'type': 'internal', 'position': 1},
+    {'id': f'context_external_tool_{TEST_SOURCE_TOOL_ID}',
+     'label': 'Source Tool', 'type': 'external', 'position': 2,
+     'hidden': False},
+    {'id': f'context_external_tool_{TEST_TARGET_TOOL_ID}',
+     'label': 'Target Tool', 'type': 'external', 'position': 3,
+     'hidden': True},
+    {'id': 'context_external_tool_3', 'label': 'Other Tool',
+     'type': 'external', 'position': 4}
+]
+
+
+class FakeCanvas:
+    """
+    Serves the test fixtures above through httpx.MockTransport like the
+    Canvas API would, including Link header pagination and tab updates
+    """
+
+    def __init__(self, courses: list[dict] | None = None,
+                 include_last_link: bool = True,
+                 max_per_page: int | None = None):
+        self.courses = TEST_COURSES if courses is None else courses
+        # Some Canvas endpoints omit the last link, e.g., when counting the
+        # pages would be too costly, and cap per_page below what was asked
+        self.include_last_link = include_last_link
+        self.max_per_page = max_per_page
+        self.cache_control = 'max-age=0, private, must-revalidate'
+        self.tabs: dict[int, list[dict]] = {
+            course['id']: [dict(tab) for tab in TEST_TABS]
+            for course in self.courses
+        }
+        self.requests: list[httpx.Request] = []
+        # Updates to these tabs are rejected, to simulate a failed PUT
+        self.failing_tab_ids: set[str] = set()
+        # Updates to these return 422, which API.put reports as None
+        self.unprocessable_tab_ids: set[str] = set()
+
+    def paginate(self, request: httpx.Request, items: list) -> httpx.Response:
+        per_page = int(request.url.params.get('per_page', 10))
+        if self.max_per_page is not None:
+            per_page = min(per_page, self.max_per_page)
+        page = int(request.url.params.get('page', 1))
+        last_page = max(1, -(-len(items) // per_page))
+
+        links = []
+        if page < last_page:
+            next_url = request.url.copy_merge_params({'page': page + 1})
+            links.append(f'<{next_url}>; rel="next"')
+        if self.include_last_link:
+            last_url = request.url.copy_merge_params({'page': last_page})
+            links.append(f'<{last_url}>; rel="last"')
+
+        return httpx.Response(
+            httpx.codes.OK,
+            json=items[(page - 1) * per_page:page * per_page],
+            headers={'Link': ', '.join(links)})
+
+    def update_tab(self, course_id: int, tab_id: str,
+                   params: httpx.QueryParams) -> httpx.Response:
+        if tab_id in self.failing_tab_ids:
+            return httpx.Response(httpx.codes.BAD_REQUEST, json={})
+        if tab_id in self.unprocessable_tab_ids:
+            return httpx.Response(httpx.codes.UNPROCESSABLE_ENTITY,
+                                  json={'errors': []})
+        for tab in self.tabs.get(course_id, []):
+            if tab['id'] == tab_id:
+                if 'hidden' in params:
+                    tab['hidden'] = params['hidden'] == 'true'
+                if 'position' in params:
+                    tab['position'] = int(params['position'])
+                return httpx.Response(httpx.codes.OK, json=tab)
+        return httpx.Response(httpx.codes.NOT_FOUND, json={})
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        response = self.route(request)
+        if request.method == 'GET' and response.status_code == httpx.codes.OK:
+            # Like Canvas, tag each body and ask clients to revalidate it
+            etag = f'"{hashlib.sha1(response.content).hexdigest()}"'
+            if request.headers.get('If-None-Match') == etag:
+                return httpx.Response(httpx.codes.NOT_MODIFIED,
+                                      headers={'ETag': etag})
+            response.headers['ETag'] = etag
+            response.headers['Cache-Control'] = self.cache_control
+        return response
+
+    def route(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix('/api/v1')
+
+        if request.method == 'PUT':
+            if match := re.fullmatch(r'/courses/(\d+)/tabs/(\w+)', path):
+                return self.update_tab(int(match[1]), match[2],
+                                       request.url.params)
+        elif match := re.fullmatch(r'/accounts/(\d+)', path):
+            return httpx.Response(httpx.codes.OK, json={
+                'id': int(match[1]), 'name': 'Test Account'})
+        elif match := re.fullmatch(r'/accounts/\d+/external_tools/(\d+)',
+                                   path):
+            for tool in TEST_TOOLS:
+                if tool['id'] == int(match[1]):
+                    return httpx.Response(httpx.codes.OK, json=tool)
+        elif re.fullmatch(r'/accounts/\d+/external_tools', path):
+            return self.paginate(request, TEST_TOOLS)
+        elif re.fullmatch(r'/accounts/\d+/courses', path):
+            term_id = request.url.params.get('enrollment_term_id')
+            return self.paginate(request, [
+                course for course in self.courses
+                if term_id is None or
+                course['enrollment_term_id'] == int(term_id)])
+        elif match := re.fullmatch(r'/courses/(\d+)/tabs', path):
+            return self.paginate(request, self.tabs.get(int(match[1]), []))
+
+        return httpx.Response(httpx.codes.NOT_FOUND, json={})
+
+
+def create_fake_api(fake_canvas: FakeCanvas) -> API:
+    return API(TEST_API_URL, TEST_API_KEY,
+               transport=httpx.MockTransport(fake_canvas))
+
+
+class APITestCase(TrioTestCase):
     """
-    Integration/unit tests for API class
+    Unit tests for API class
     """
 
-    async def setUp(self) -> None:
-        self.api_url: str = os.getenv('API_URL', '')
-        api_key: str = os.getenv('API_KEY', '')
-        self.api = API(self.api_url, api_key)
-        self.account_id = int(os.getenv('ACCOUNT_ID', 0))
+    def setUp(self) -> None:
+        self.api_url = TEST_API_URL
+        self.fake_canvas = FakeCanvas()
+        self.api = create_fake_api(self.fake_canvas)
+        self.account_id = TEST_ACCOUNT_ID
 
         self.course_url = '/courses/11111111/'
-        self.course_data = [{'name': 'Test Course'}]
+        self.course_data = TEST_COURSE_DATA
+
+        # Retry without the backoff waits, which only slow the tests down
+        for method in (API.get, API.put):
+            patcher = patch.object(method.retry, 'sleep', AsyncMock())
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
     def test_get_next_page_params_with_no_next_page(self):
-        mock_response = MagicMock(httpx.Response)
-        mock_response.links = {
-            'next': {
-                'url': f'{self.api_url}/api/v1/accounts/{self.account_id}'
-                       '/courses/?page=2&per_page=5',
-                'rel': 'next'
-            }
-        }
-        params = API.get_next_page_params(mock_response)
-        self.assertEqual(params, {'page': ['2'], 'per_page': ['5']})
+        next_url = (f'{self.api_url}/api/v1/accounts/{self.account_id}'
+                    '/courses/?page=2&per_page=5')
+        response = httpx.Response(
+            status_code=httpx.codes.OK,
+            headers={'Link': f'<{next_url}>; rel="next"'}
+        )
+        params = API.get_next_page_params(response)
+        self.assertEqual(params, [('page', '2'), ('per_page', '5')])
+
+    def test_get_query_params_keeps_repeated_params(self):
+        params = API.get_query_params(
+            f'{self.api_url}/api/v1/courses?include%5B%5D=term'
+            '&include%5B%5D=teachers&page=2')
+        self.assertEqual(params, [('include[]', 'term'),
+                                  ('include[]', 'teachers'),
+                                  ('page', '2')])
 
     async def test_get_results_from_pages(self):
         async with self.api.client:
             results = await self.api.get_results_from_pages(
                 f'/accounts/{self.account_id}/courses', page_size=5)
-        self.assertTrue(len(results) > 1)
+        self.assertEqual(results, TEST_COURSES)
 
     async def test_get_results_from_pages_with_limit(self):
         async with self.api.client:
@@ -61,6 +261,90 @@ class APITestCase(unittest.IsolatedAsyncioTestCase):
             )
         self.assertTrue(len(results) == 2)
 
+    async def test_get_results_from_pages_does_not_cache_pages(self):
+        async with self.api.client:
+            results = await self.api.get_results_from_pages(
+                f'/accounts/{self.account_id}/courses', page_size=5)
+        self.assertEqual(results, TEST_COURSES)
+        self.assertEqual(len(self.api.cache), 0)
+
+    async def test_get_results_from_pages_keeps_repeated_params(self):
+        async with self.api.client:
+            results = await self.api.get_results_from_pages(
+                f'/accounts/{self.account_id}/courses',
+                params={'include[]': ['term', 'teachers']}, page_size=5)
+        self.assertEqual(results, TEST_COURSES)
+        self.assertEqual(len(self.fake_canvas.requests), 3)
+        for request in self.fake_canvas.requests:
+            self.assertEqual(request.url.params.get_list('include[]'),
+                             ['term', 'teachers'])
+
+    async def test_get_results_from_pages_without_last_link(self):
+        fake_canvas = FakeCanvas(include_last_link=False)
+        api = create_fake_api(fake_canvas)
+        async with api.client:
+            results = await api.get_results_from_pages(
+                f'/accounts/{self.account_id}/courses',
+                params={'include[]': ['term', 'teachers']}, page_size=5)
+            limited_results = await api.get_results_from_pages(
+                f'/accounts/{self.account_id}/courses', page_size=5,
+                limit=7)
+        self.assertEqual(results, TEST_COURSES)
+        self.assertEqual(limited_results, TEST_COURSES[:7])
+        # Three pages for all of the courses, then two for the first seven
+        self.assertEqual(len(fake_canvas.requests), 5)
+        for request in fake_canvas.requests[:3]:
+            self.assertEqual(request.url.params.get_list('include[]'),
+                             ['term', 'teachers'])
+
+    async def test_get_results_from_pages_limit_uses_returned_page_size(self):
+        fake_canvas = FakeCanvas(max_per_page=5)
+        api = create_fake_api(fake_canvas)
+        async with api.client:
+            results = await api.get_results_from_pages(
+                f'/accounts/{self.account_id}/courses', page_size=50,
+                limit=7)
+        self.assertEqual(results, TEST_COURSES[:7])
+        self.assertEqual(len(fake_canvas.requests), 2)
+
+    async def test_iter_pages_sends_pages_before_fetching_them_all(self):
+        courses = [
+            {'id': 1000 + i, 'name': f'Course {i}',
+             'enrollment_term_id': TEST_TERM_IDS[0]}
+            for i in range(1000)
+        ]
+        fake_canvas = FakeCanvas(courses)
+        api = create_fake_api(fake_canvas)
+        async with api.client:
+            async with api.iter_pages(
+                    f'/accounts/{self.account_id}/courses',
+                    page_size=10) as pages:
+                first_page = await pages.receive()
+                second_page = await pages.receive()
+                num_requests = len(fake_canvas.requests)
+        self.assertEqual(first_page + second_page, courses[:20])
+        # Only a window of pages was fetched ahead, not all 100
+        self.assertLessEqual(num_requests, 2 + PAGE_WINDOW)
+
+    async def test_get_results_from_pages_walks_every_page(self):
+        courses = [
+            {'id': 1000 + i, 'name': f'Course {i}',
+             'enrollment_term_id': TEST_TERM_IDS[0]}
+            for i in range(5000)
+        ]
+        fake_canvas = FakeCanvas(courses)
+        api = create_fake_api(fake_canvas)
+
+        start = time.perf_counter()
+        async with api.client:
+            results = await api.get_results_from_pages(
+                f'/accounts/{self.account_id}/courses', page_size=50)
+        logger.info('Fetched %d pages in %.3f seconds',
+                    len(fake_canvas.requests), time.perf_counter() - start)
+
+        self.assertEqual(results, courses)
+        self.assertEqual(len(fake_canvas.requests), 100)
+
     async def test_get_retries_on_http_error(self):
         request = MagicMock(httpx.Request, autospec=True,
                             url=self.course_url)
@@ -71,7 +355,7 @@ class APITestCase(unittest.IsolatedAsyncioTestCase):
         expected_resp = httpx.Response(
             status_code=httpx.codes.OK,
             request=request,
-            text=json.dumps(self.course_data)
+            json=self.course_data
         )
 
         with patch.object(self.api.client, 'get',
@@ -88,12 +372,12 @@ class APITestCase(unittest.IsolatedAsyncioTestCase):
         bad_json_resp = httpx.Response(
             status_code=httpx.codes.OK,
             request=MagicMock(spec=httpx.Request),
-            text=json.dumps(self.course_data)[:-3],  # Simulate malformed JSON
+            content=TEST_COURSE_BODY[:-3],  # Simulate malformed JSON
         )
         expected_resp = httpx.Response(
             status_code=httpx.codes.OK,
             request=request,
-            text=json.dumps(self.course_data)
+            json=self.course_data
         )
         with patch.object(self.api.client, 'get',
                           autospec=True) as mock_get_call:
@@ -103,6 +387,85 @@ class APITestCase(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(self.course_data, result.data)
         self.assertEqual(mock_get_call.call_count, 2)
 
+    async def test_get_retries_after_too_many_requests(self):
+        request = MagicMock(httpx.Request, autospec=True,
+                            url=self.course_url)
+        resp = httpx.Response(
+            status_code=httpx.codes.TOO_MANY_REQUESTS,
+            request=request,
+            headers={'Retry-After': '0'}
+        )
+        expected_resp = httpx.Response(
+            status_code=httpx.codes.OK,
+            request=request,
+            json=self.course_data
+        )
+
+        with patch.object(self.api.client, 'get',
+                          autospec=True) as mock_get_call:
+            mock_get_call.side_effect = [resp, expected_resp]
+            async with self.api.client:
+                result = await self.api.get(self.course_url)
+        self.assertEqual(self.course_data, result.data)
+        self.assertEqual(mock_get_call.call_count, 2)
+
+    async def test_get_uses_cache_unless_bypassed(self):
+        request = MagicMock(httpx.Request, autospec=True,
+                            url=self.course_url)
+        resp = httpx.Response(
+            status_code=httpx.codes.OK,
+            request=request,
+            json=self.course_data
+        )
+
+        with patch.object(self.api.client, 'get',
+                          autospec=True) as mock_get_call:
+            mock_get_call.return_value = resp
+            async with self.api.client:
+                await self.api.get(self.course_url)
+                result = await self.api.get(self.course_url)
+                self.assertEqual(mock_get_call.call_count, 1)
+                await self.api.get(self.course_url, cache_mode=CacheMode.NONE)
+        self.assertEqual(self.course_data, result.data)
+        self.assertEqual(mock_get_call.call_count, 2)
+
+    async def test_get_revalidates_cached_response_with_etag(self):
+        async with self.api.client:
+            first_result = await self.api.get('/accounts/1')
+            second_result = await self.api.get('/accounts/1')
+        first_request, second_request = self.fake_canvas.requests
+        self.assertNotIn('If-None-Match', first_request.headers)
+        self.assertIn('If-None-Match', second_request.headers)
+        # The 304 reuses the cached response rather than decoding a new one
+        self.assertIs(second_result, first_result)
+
+    async def test_get_refetches_changed_response(self):
+        course_id = TEST_COURSES[0]['id']
+        async with self.api.client:
+            first_result = await self.api.get(f'/courses/{course_id}/tabs')
+            self.fake_canvas.tabs[course_id][1]['hidden'] = True
+            second_result = await self.api.get(f'/courses/{course_id}/tabs')
+        self.assertIsNot(second_result, first_result)
+        self.assertTrue(second_result.data[1]['hidden'])
+
+    async def test_get_reuses_fresh_response_without_request(self):
+        self.fake_canvas.cache_control = 'max-age=300, private'
+        async with self.api.client:
+            first_result = await self.api.get('/accounts/1')
+            second_result = await self.api.get('/accounts/1')
+        self.assertEqual(len(self.fake_canvas.requests), 1)
+        self.assertIs(second_result, first_result)
+
+    async def test_get_does_not_cache_no_store_response(self):
+        self.fake_canvas.cache_control = 'no-store'
+        async with self.api.client:
+            first_result = await self.api.get('/accounts/1')
+            second_result = await self.api.get('/accounts/1')
+        self.assertEqual(len(self.fake_canvas.requests), 2)
+        self.assertNotIn('If-None-Match', self.fake_canvas.requests[1].headers)
+        self.assertIsNot(second_result, first_result)
+        self.assertEqual(second_result.data, first_result.data)
+
     async def test_put_retries_until_failure(self):
         request = MagicMock(httpx.Request, autospec=True,
                             url=self.course_url)
@@ -121,18 +484,15 @@ class APITestCase(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(mock_put_call.call_count, 4)
 
 
-class AccountManagerTestCase(unittest.IsolatedAsyncioTestCase):
+class AccountManagerTestCase(TrioTestCase):
     """
-    Integration tests for AccountManager class
+    Unit tests for AccountManager class
     """
 
     def setUp(self) -> None:
-        api_url: str = os.getenv('API_URL', '')
-        api_key: str = os.getenv('API_KEY', '')
-        self.test_account_id = int(os.getenv('TEST_ACCOUNT_ID', 0))
-        self.enrollment_term_ids: list[int] = convert_csv_to_int_list(
-            os.getenv('ENROLLMENT_TERM_IDS_CSV', '0'))
-        self.api = API(api_url, api_key)
+        self.test_account_id = TEST_ACCOUNT_ID
+        self.enrollment_term_ids = TEST_TERM_IDS
+        self.api = create_fake_api(FakeCanvas())
 
     async def test_manager_get_tools(self):
         async with self.api.client:
@@ -143,11 +503,26 @@ class AccountManagerTestCase(unittest.IsolatedAsyncioTestCase):
             logger.debug(tool)
             self.assertTrue(isinstance(tool, ExternalTool))
 
+    async def test_manager_fetches_tools_once_until_invalidated(self):
+        manager = AccountManager(self.test_account_id, self.api)
+        with patch.object(
+                manager, 'fetch_tools_installed_in_account',
+                wraps=manager.fetch_tools_installed_in_account) as mock_fetch:
+            async with self.api.client:
+                tools = await manager.get_tools_installed_in_account()
+                self.assertIs(
+                    await manager.get_tools_installed_in_account(), tools)
+                self.assertEqual(mock_fetch.call_count, 1)
+
+                manager.invalidate_tools()
+                await manager.get_tools_installed_in_account()
+        self.assertEqual(mock_fetch.call_count, 2)
+
     async def test_manager_get_courses_in_single_term(self):
         async with self.api.client:
             manager = AccountManager(self.test_account_id, self.api)
             courses = await manager.get_courses_in_terms(
-                [self.enrollment_term_ids[0]], 150)
+                [self.enrollment_term_ids[0]], 2)
         self.assertTrue(len(courses) > 0)
         term_ids: list[int] = []
         for course in courses:
@@ -160,7 +535,8 @@ class AccountManagerTestCase(unittest.IsolatedAsyncioTestCase):
         async with self.api.client:
             manager = AccountManager(self.test_account_id, self.api)
             courses = await manager.get_courses_in_terms(
-                self.enrollment_term_ids)
+                self.enrollment_term_ids,
+                limit=len(self.enrollment_term_ids) * 2)
         self.assertTrue(len(courses) > 0)
         term_ids: list[int] = []
         for course in courses:
@@ -173,19 +549,27 @@ class AccountManagerTestCase(unittest.IsolatedAsyncioTestCase):
         async with self.api.client:
             manager = AccountManager(self.test_account_id, self.api)
             courses = await manager.get_courses_in_terms(
-                self.enrollment_term_ids, 50)
+                self.enrollment_term_ids, 3)
         self.assertTrue(len(courses) > 0)
         for course in courses:
             self.assertTrue(isinstance(course, Course))
-        self.assertTrue(len(courses) <= 50)
+        self.assertTrue(len(courses) <= 3)
 
 
-class WarehouseAccountManagerTestCase(unittest.IsolatedAsyncioTestCase):
+class WarehouseAccountManagerTestCase(TrioTestCase):
     """
     Integration tests for WarehouseAccountManager class
     """
 
-    def setUp(self) -> None:
+    @classmethod
+    def setUpClass(cls) -> None:
+        # Checked here rather than with a decorator so the .env loaded by
+        # setUpModule after import still counts
+        required_vars = ('API_URL', 'API_KEY', 'TEST_ACCOUNT_ID', 'WH_HOST')
+        if not all(os.getenv(var) for var in required_vars):
+            raise unittest.SkipTest(
+                'Warehouse integration tests need ' + ', '.join(required_vars))
+
         wh_db_params: DBParams = {
             'host': os.getenv('WH_HOST', ''),
             'port': os.getenv('WH_PORT', ''),
@@ -194,14 +578,23 @@ class WarehouseAccountManagerTestCase(unittest.IsolatedAsyncioTestCase):
             'password': os.getenv('WH_PASSWORD', '')
         }
 
-        api_url: str = os.getenv('API_URL', '')
-        api_key: str = os.getenv('API_KEY', '')
-        self.api = API(api_url, api_key)
-
-        self.enrollment_term_ids: list[int] = convert_csv_to_int_list(
+        cls.api_url: str = os.getenv('API_URL', '')
+        cls.api_key: str = os.getenv('API_KEY', '')
+        cls.enrollment_term_ids: list[int] = convert_csv_to_int_list(
             os.getenv('ENROLLMENT_TERM_IDS_CSV', '0'))
-        self.db = DB(Dialect.POSTGRES, wh_db_params)
-        self.test_account_id = int(os.getenv('TEST_ACCOUNT_ID', 0))
+        cls.test_account_id = int(os.getenv('TEST_ACCOUNT_ID', 0))
+        # Connect once for the whole class; each test reuses the connection
+        cls.db = DB(Dialect.POSTGRES, wh_db_params)
+        cls.db.__enter__()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.db.__exit__(None, None, None)
+
+    def setUp(self) -> None:
+        # httpx clients are bound to the trio run that opens them, so each
+        # test still needs its own
+        self.api = API(self.api_url, self.api_key)
 
     async def test_get_subaccount_ids(self):
         async with self.api.client:
@@ -213,12 +606,11 @@ class WarehouseAccountManagerTestCase(unittest.IsolatedAsyncioTestCase):
             self.assertIsInstance(subaccount_id, int)
 
     async def test_manager_get_courses_in_single_term(self):
-        with self.db:
-            async with self.api.client:
-                manager = WarehouseAccountManager(
-                    account_id=self.test_account_id, db=self.db, api=self.api)
-                courses = await manager.get_courses_in_terms(
-                    [self.enrollment_term_ids[0]], 150)
+        async with self.api.client:
+            manager = WarehouseAccountManager(
+                account_id=self.test_account_id, db=self.db, api=self.api)
+            courses = await manager.get_courses_in_terms(
+                [self.enrollment_term_ids[0]], 5)
         self.assertTrue(len(courses) > 0)
         term_ids: list[int] = []
         for course in courses:
@@ -228,12 +620,11 @@ class WarehouseAccountManagerTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertTrue(len(term_id_set) == 1)
 
     async def test_manager_get_courses_in_multiple_terms(self):
-        with self.db:
-            async with self.api.client:
-                manager = WarehouseAccountManager(
-                    account_id=self.test_account_id, db=self.db, api=self.api)
-                courses = await manager.get_courses_in_terms(
-                    self.enrollment_term_ids)
+        async with self.api.client:
+            manager = WarehouseAccountManager(
+                account_id=self.test_account_id, db=self.db, api=self.api)
+            courses = await manager.get_courses_in_terms(
+                self.enrollment_term_ids)
         self.assertTrue(len(courses) > 0)
         term_ids: list[int] = []
         for course in courses:
@@ -243,36 +634,34 @@ class WarehouseAccountManagerTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertTrue(len(term_id_set) > 1)
 
     async def test_manager_get_courses_with_limit(self):
-        with self.db:
-            async with self.api.client:
-                manager = WarehouseAccountManager(self.test_account_id,
-                                                  self.db, api=self.api)
-                courses = await manager.get_courses_in_terms(
-                    self.enrollment_term_ids, 50)
+        async with self.api.client:
+            manager = WarehouseAccountManager(self.test_account_id,
+                                              self.db, api=self.api)
+            courses = await manager.get_courses_in_terms(
+                self.enrollment_term_ids, 5)
         self.assertTrue(len(courses) > 0)
         for course in courses:
             self.assertTrue(isinstance(course, Course))
-        self.assertTrue(len(courses) <= 50)
+        self.assertTrue(len(courses) <= 5)
 
 
-class CourseManagerTestCase(unittest.IsolatedAsyncioTestCase):
+class CourseManagerTestCase(TrioTestCase):
     """
-    Integration/unit tests for CourseManager class
+    Unit tests for CourseManager class
     """
 
     async def asyncSetUp(self):
-        api_url: str = os.getenv('API_URL', '')
-        api_key: str = os.getenv('API_KEY', '')
-        self.api = API(api_url, api_key)
-        self.test_course_id: int = int(os.getenv('TEST_COURSE_ID', '0'))
+        self.fake_canvas = FakeCanvas()
+        self.api = create_fake_api(self.fake_canvas)
+        self.test_course_id: int = TEST_COURSES[0]['id']
         course = Course(
             self.test_course_id,
             name='Test Course',
             enrollment_term_id=0  # Just faking this, it won't be used
         )
         self.course_manager = CourseManager(course, self.api)
-        self.source_tool_id: int = int(os.getenv('SOURCE_TOOL_ID', '0'))
-        self.target_tool_id: int = int(os.getenv('TARGET_TOOL_ID', '0'))
+        self.source_tool_id = TEST_SOURCE_TOOL_ID
+        self.target_tool_id = TEST_TARGET_TOOL_ID
 
         self.test_external_tool_tab = ExternalToolTab(
             id='context_external_tool_99999',
@@ -282,22 +671,20 @@ class CourseManagerTestCase(unittest.IsolatedAsyncioTestCase):
             position=30
         )
 
-        setup_api = API(api_url, api_key)
+        setup_api = create_fake_api(self.fake_canvas)
         setup_course_manager = CourseManager(course, setup_api)
         async with setup_api.client:
             tabs_before = await setup_course_manager.get_tool_tabs()
-            source_tab = CourseManager.find_tab_by_tool_id(
-                self.source_tool_id, tabs_before)
-            target_tab = CourseManager.find_tab_by_tool_id(
-                self.target_tool_id, tabs_before)
-            if source_tab is None or target_tab is None:
+            tabs_by_tool_id = CourseManager.find_tabs_by_tool_ids(
+                {self.source_tool_id, self.target_tool_id}, tabs_before)
+            if len(tabs_by_tool_id) < 2:
                 raise Exception(
                     'One or both of the tools with these IDs are not '
                     'available in this course: ' +
                     str([self.source_tool_id, self.target_tool_id])
                 )
-            self.source_tab = source_tab
-            self.target_tab = target_tab
+            self.source_tab = tabs_by_tool_id[self.source_tool_id]
+            self.target_tab = tabs_by_tool_id[self.target_tool_id]
 
     def test_find_tab_by_tool_id_returns_tab(self):
         tab = CourseManager.find_tab_by_tool_id(
@@ -309,6 +696,11 @@ class CourseManagerTestCase(unittest.IsolatedAsyncioTestCase):
             100000, [self.test_external_tool_tab])
         self.assertTrue(tab is None)
 
+    def test_find_tabs_by_tool_ids_returns_found_tabs(self):
+        tabs = CourseManager.find_tabs_by_tool_ids(
+            {99999, 100000}, [self.test_external_tool_tab])
+        self.assertEqual(tabs, {99999: self.test_external_tool_tab})
+
     async def test_manager_gets_tool_tabs_in_course(self):
         async with self.api.client:
             tabs = await self.course_manager.get_tool_tabs()
@@ -381,6 +773,44 @@ class CourseManagerTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertTrue(new_source_tab.is_hidden)
         self.assertFalse(new_target_tab.is_hidden)
         self.assertEqual(old_source_tab.position, new_target_tab.position)
+        # The target is shown before the source is hidden
+        self.assertEqual(
+            [request.url.path.rpartition('/')[2]
+             for request in self.fake_canvas.requests[-2:]],
+            [self.target_tab.id, self.source_tab.id])
+
+    async def test_manager_replace_tool_tab_keeps_source_if_target_update_fails(
+            self):
+        self.fake_canvas.failing_tab_ids.add(self.target_tab.id)
+        async with self.api.client:
+            with self.assertRaises(httpx.HTTPStatusError):
+                await self.course_manager.replace_tool_tab(
+                    self.source_tab, self.target_tab)
+            tabs = await self.course_manager.get_tool_tabs()
+
+        source_tab = CourseManager.find_tab_by_tool_id(
+            self.source_tool_id, tabs)
+        self.assertIsNotNone(source_tab)
+        self.assertFalse(source_tab.is_hidden)
+
+    async def test_manager_replace_tool_tab_keeps_source_if_target_unprocessable(
+            self):
+        self.fake_canvas.unprocessable_tab_ids.add(self.target_tab.id)
+        async with self.api.client:
+            with self.assertLogs('manager', logging.WARNING):
+                new_source_tab, new_target_tab = (
+                    await self.course_manager.replace_tool_tab(
+                        self.source_tab, self.target_tab))
+            tabs = await self.course_manager.get_tool_tabs()
+
+        self.assertEqual(new_source_tab, self.source_tab)
+        self.assertIsNone(new_target_tab)
+        self.assertEqual(
+            [request.method for request in self.fake_canvas.requests].count(
+                'PUT'), 1)
+        source_tab = CourseManager.find_tab_by_tool_id(
+            self.source_tool_id, tabs)
+        self.assertFalse(source_tab.is_hidden)
 
     async def test_manager_replace_tool_tab_only_hides_source_if_target_available(
             self):
@@ -417,12 +847,21 @@ class UtilsTestCase(unittest.TestCase):
         tool = find_entity_by_id(77778, [self.test_external_tool])
         self.assertTrue(tool is None)
 
+    def test_find_tool_by_id_uses_index(self):
+        tools_by_id = build_entity_index([self.test_external_tool])
+        self.assertEqual(tools_by_id, {77777: self.test_external_tool})
+        self.assertIs(find_entity_by_id(77777, tools_by_id),
+                      self.test_external_tool)
+        self.assertIsNone(find_entity_by_id(77778, tools_by_id))
+
     def test_convert_csv_to_int_list_when_valid(self):
         int_list = convert_csv_to_int_list('6,7,8')
         for elem in int_list:
             self.assertIsInstance(elem, int)
         int_list = convert_csv_to_int_list('6')
         self.assertIsInstance(int_list[0], int)
+        int_list = convert_csv_to_int_list(' 6, 7,\n8 ')
+        self.assertEqual(int_list, [6, 7, 8])
 
     def test_convert_csv_to_int_list_when_invalid(self):
         with self.assertRaises(ConfigException):
@@ -431,75 +870,215 @@ class UtilsTestCase(unittest.TestCase):
             convert_csv_to_int_list(',')
         with self.assertRaises(ConfigException):
             convert_csv_to_int_list('')
+        with self.assertRaises(ConfigException):
+            convert_csv_to_int_list('6,7 8')
 
     def test_chunk_integer(self):
-        chunks = chunk_integer(150, 3)
-        self.assertEqual(chunks, [50, 50, 50])
-        chunks = chunk_integer(5, 2)
-        self.assertEqual(chunks, [3, 2])
-        chunks = chunk_integer(23, 5)
-        self.assertEqual(chunks, [5, 5, 5, 4, 4])
-        chunks = chunk_integer(14, 4)
-        self.assertEqual(chunks, [4, 4, 3, 3])
-        chunks = chunk_integer(2, 3)
-        self.assertEqual(chunks, [1, 1, 0])
-        chunks = chunk_integer(0, 3)
-        self.assertEqual(chunks, [0, 0, 0])
+        cases: list[tuple[int, int, list[int] | None]] = [
+            (150, 3, [50, 50, 50]),
+            (5, 2, [3, 2]),
+            (23, 5, [5, 5, 5, 4, 4]),
+            (14, 4, [4, 4, 3, 3]),
+            (2, 3, [1, 1, 0]),
+            (0, 3, [0, 0, 0]),
+            (7, 4, [2, 2, 2, 1]),
+            (11, 4, [3, 3, 3, 2]),
+            (10_000_000, 7, None)
+        ]
+        for value, num_chunks, expected in cases:
+            with self.subTest(value=value, num_chunks=num_chunks):
+                chunks = chunk_integer(value, num_chunks)
+                if expected is not None:
+                    self.assertEqual(chunks, expected)
+                self.assertEqual(len(chunks), num_chunks)
+                self.assertEqual(sum(chunks), value)
+        for value in range(50):
+            for num_chunks in range(1, 10):
+                with self.subTest(value=value, num_chunks=num_chunks):
+                    chunks = chunk_integer(value, num_chunks)
+                    self.assertEqual(sum(chunks), value)
+                    self.assertLessEqual(max(chunks) - min(chunks), 1)
         with self.assertRaises(Exception):
             chunks = chunk_integer(-1, 2)
         with self.assertRaises(Exception):
             chunks = chunk_integer(2, -1)
 
+    def test_disk_cache_reuses_result_when_cache_dir_set(self):
+        calls: list[int] = []
+
+        @disk_cache(lambda value: f'test_{value}')
+        async def double(value: int) -> int:
+            calls.append(value)
+            return value * 2
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with patch.dict(os.environ, {'CACHE_DIR': cache_dir}):
+                self.assertEqual(trio.run(double, 3), 6)
+                self.assertEqual(trio.run(double, 3), 6)
+        self.assertEqual(calls, [3])
+
+        with patch.dict(os.environ, {'CACHE_DIR': ''}):
+            trio.run(double, 3)
+        self.assertEqual(calls, [3, 3])
+
     def test_time_execution(self):
         @time_execution
-        def sleep(duration: int):
-            time.sleep(duration)
+        async def sleep(duration: float):
+            await trio.sleep(duration)
 
         with self.assertLogs('utils', logging.INFO) as cm:
-            sleep(4)
+            trio.run(sleep, 0.1)
         logger.info(cm.output)
         self.assertRegex(cm.output[0], re.compile(
             r'sleep took \d+\.\d+ seconds to complete\.'))
+        self.assertEqual(cm.records[0].func, sleep.__qualname__)
+        self.assertGreaterEqual(cm.records[0].duration_s, 0.1)
 
 
-class MainTestCase(unittest.IsolatedAsyncioTestCase):
+class MainTestCase(TrioTestCase):
 
     def setUp(self) -> None:
-        api_url: str = os.getenv('API_URL', '')
-        api_key: str = os.getenv('API_KEY', '')
-        self.api = API(api_url, api_key)
-        self.account_id: int = int(os.getenv('ACCOUNT_ID', '0'))
-        self.enrollment_term_ids: list[int] = convert_csv_to_int_list(
-            os.getenv('ENROLLMENT_TERM_IDS_CSV', '0'))
+        self.fake_canvas = FakeCanvas()
+        self.api = create_fake_api(self.fake_canvas)
+        self.account_id = TEST_ACCOUNT_ID
+        self.enrollment_term_ids = TEST_TERM_IDS
 
-        self.source_tool_id: int = int(os.getenv('SOURCE_TOOL_ID', '0'))
-        self.target_tool_id: int = int(os.getenv('TARGET_TOOL_ID', '0'))
+        self.source_tool_id = TEST_SOURCE_TOOL_ID
+        self.target_tool_id = TEST_TARGET_TOOL_ID
 
-    async def test_find_tool_ids_for_migrations_raises_exception_when_tool_ids_are_invalid(
+    def test_find_tool_ids_for_migrations_raises_exception_when_tool_ids_are_invalid(
             self):
-        async with self.api.client:
-            account_manager = AccountManager(self.account_id, self.api)
-            tools = await account_manager.get_tools_installed_in_account()
+        # Fetching is covered by AccountManagerTestCase, so build the tools
+        # straight from the fixture rather than walking the pages again
+        tools = [ExternalTool(**tool) for tool in TEST_TOOLS]
         with self.assertRaises(InvalidToolIdsException):
             find_tools_for_migrations(
                 tools, [ToolMigration(100000000, 100000001)])
 
+    def test_find_tool_ids_for_migrations_reports_all_invalid_tool_ids(self):
+        tools = [ExternalTool(**tool) for tool in TEST_TOOLS]
+        migrations = [
+            ToolMigration(self.source_tool_id, 100000000),
+            ToolMigration(100000001, self.target_tool_id),
+            ToolMigration(100000000, self.target_tool_id)
+        ]
+        with self.assertRaisesRegex(InvalidToolIdsException,
+                                    r'\[100000000, 100000001\]'):
+            find_tools_for_migrations(tools, migrations)
+
+    def test_find_tool_ids_for_migrations_pairs_tools(self):
+        tools = [ExternalTool(**tool) for tool in TEST_TOOLS]
+        tool_pairs = find_tools_for_migrations(
+            tools, [ToolMigration(self.source_tool_id, self.target_tool_id)])
+        self.assertEqual(
+            [(source.id, target.id) for source, target in tool_pairs],
+            [(self.source_tool_id, self.target_tool_id)])
+
+    def run_main(self, migrations: list[ToolMigration],
+                 **kwargs: Any) -> None:
+        async def run():
+            api = create_fake_api(self.fake_canvas)
+            async with api.client:
+                await main(api, self.account_id, self.enrollment_term_ids,
+                           migrations, **kwargs)
+
+        trio.run(run)
+
+    def test_run_rejects_max_concurrent_courses_below_one(self):
+        for value in ('0', '-1'):
+            with self.subTest(value=value), \
+                    patch.dict(os.environ, {'MAX_CONCURRENT_COURSES': value}), \
+                    patch('main.load_dotenv'), \
+                    patch('main.trio.run') as trio_run:
+                with self.assertRaises(ConfigException):
+                    run()
+                trio_run.assert_not_called()
+
     def test_main_migrates_tool_successfully(self):
-        trio.run(
-            main,
-            self.api,
-            self.account_id,
-            self.enrollment_term_ids,
-            [ToolMigration(source_id=self.source_tool_id,
-                           target_id=self.target_tool_id)]
+        self.run_main([ToolMigration(source_id=self.source_tool_id,
+                                     target_id=self.target_tool_id)])
+        source_tab_id = f'context_external_tool_{self.source_tool_id}'
+        target_tab_id = f'context_external_tool_{self.target_tool_id}'
+        for course in TEST_COURSES:
+            tabs = {tab['id']: tab for tab in self.fake_canvas.tabs[course['id']]}
+            self.assertTrue(tabs[source_tab_id]['hidden'])
+            self.assertFalse(tabs[target_tab_id]['hidden'])
+            self.assertEqual(tabs[target_tab_id]['position'], 2)
+
+    def test_main_migrates_every_course_with_fewest_workers(self):
+        source_tab_id = f'context_external_tool_{self.source_tool_id}'
+        target_tab_id = f'context_external_tool_{self.target_tool_id}'
+        # One runs a single combined worker; two, the smallest pipeline
+        for max_concurrent_courses in (1, 2):
+            with self.subTest(max_concurrent_courses=max_concurrent_courses):
+                self.fake_canvas = FakeCanvas()
+                self.run_main(
+                    [ToolMigration(source_id=self.source_tool_id,
+                                   target_id=self.target_tool_id)],
+                    max_concurrent_courses=max_concurrent_courses)
+                for course in TEST_COURSES:
+                    tabs = {tab['id']: tab for tab
+                            in self.fake_canvas.tabs[course['id']]}
+                    self.assertTrue(tabs[source_tab_id]['hidden'])
+                    self.assertFalse(tabs[target_tab_id]['hidden'])
+
+    def test_main_skips_course_missing_a_tab_and_migrates_the_rest(self):
+        source_tab_id = f'context_external_tool_{self.source_tool_id}'
+        target_tab_id = f'context_external_tool_{self.target_tool_id}'
+        missing_course_id = TEST_COURSES[0]['id']
+        self.fake_canvas.tabs[missing_course_id] = [
+            tab for tab in self.fake_canvas.tabs[missing_course_id]
+            if tab['id'] != target_tab_id
+        ]
+
+        with self.assertLogs('main', logging.WARNING) as cm:
+            self.run_main([ToolMigration(source_id=self.source_tool_id,
+                                         target_id=self.target_tool_id)])
+
+        self.assertTrue(any(
+            'Skipping migration' in line and str(missing_course_id) in line
+            for line in cm.output
+        ))
+        missing_tabs = {
+            tab['id']: tab for tab in self.fake_canvas.tabs[missing_course_id]
+        }
+        self.assertFalse(missing_tabs[source_tab_id]['hidden'])
+        for course in TEST_COURSES[1:]:
+            tabs = {tab['id']: tab for tab in self.fake_canvas.tabs[course['id']]}
+            self.assertTrue(tabs[source_tab_id]['hidden'])
+            self.assertFalse(tabs[target_tab_id]['hidden'])
+
+    def test_main_applies_repeated_migration_once(self):
+        migration = ToolMigration(source_id=self.source_tool_id,
+                                  target_id=self.target_tool_id)
+        self.run_main([migration, migration])
+
+        put_paths = Counter(
+            request.url.path for request in self.fake_canvas.requests
+            if request.method == 'PUT'
         )
-        # what needs to be checked?
+        # One PUT for each course's target tab and one for its source tab
+        self.assertEqual(len(put_paths), 2 * len(TEST_COURSES))
+        self.assertEqual(set(put_paths.values()), {1})
+
+    def test_main_reports_migrated_courses_as_unchanged_on_rerun(self):
+        migrations = [ToolMigration(source_id=self.source_tool_id,
+                                    target_id=self.target_tool_id)]
+        with self.assertLogs('main', logging.INFO) as first_cm:
+            self.run_main(migrations)
+        with self.assertLogs('main', logging.INFO) as second_cm:
+            self.run_main(migrations)
+
+        num_courses = len(TEST_COURSES)
+        self.assertIn(
+            f'Courses changed: {num_courses}; already migrated or skipped: 0',
+            '\n'.join(first_cm.output))
+        self.assertIn(
+            f'Courses changed: 0; already migrated or skipped: {num_courses}',
+            '\n'.join(second_cm.output))
 
 
 if __name__ == '__main__':
-    root_dir: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    load_dotenv(os.path.join(root_dir, '.env'), verbose=True)
-
     log_level = os.getenv('LOG_LEVEL', 'INFO')
     http_log_level = os.getenv('HTTP_LOG_LEVEL', 'WARN')
     logging.basicConfig(level=log_level)
@@ -1,7 +1,9 @@
 import functools
 import logging
+import os
+import pickle
 import time
-from typing import Callable, TypeVar
+from typing import Callable, Iterable, TypeVar
 
 from data import CanvasEntity
 from exceptions import ConfigException
@@ -10,19 +12,24 @@ logger = logging.getLogger(__name__)
 
 T = TypeVar('T', bound=CanvasEntity)
 
+DISK_CACHE_TTL = 3600
 
-def find_entity_by_id(id: int, entities: list[T]) -> T | None:
-    for entity in entities:
-        if entity.id == id:
-            return entity
-    return None
+
+def build_entity_index(entities: Iterable[T]) -> dict[int, T]:
+    return {entity.id: entity for entity in entities}
+
+
+def find_entity_by_id(id: int, entities: list[T] | dict[int, T]) -> T | None:
+    if isinstance(entities, dict):
+        return entities.get(id)
+    return next((entity for entity in entities if entity.id == id), None)
 
 
 def convert_csv_to_int_list(csv_string: str) -> list[int]:
     string_list = csv_string.split(',')
     logger.debug(string_list)
     try:
-        int_list = [int(elem) for elem in string_list]
+        int_list = list(map(int, string_list))
     except ValueError:
         exception = ConfigException()
         exception.add_note(
@@ -43,26 +50,57 @@ def chunk_integer(value: int, num_chunks: int) -> list[int]:
             'num_chunks parameter for chunk_integer must be '
             'a positive integer.')
 
-    chunks: list[int] = []
-    div_floor = (value // num_chunks)
-    remainder = value % div_floor if div_floor > 0 else value
-    for i in range(num_chunks):
-        if i < remainder:
-            chunks.append(div_floor + 1)
-        else:
-            chunks.append(div_floor)
-    return chunks
+    div_floor, remainder = divmod(value, num_chunks)
+    return [div_floor + 1] * remainder + [div_floor] * (num_chunks - remainder)
 
 
 def time_execution(callable: Callable) -> Callable:
     @functools.wraps(callable)
     async def wrapper(*args, **kwargs):
-        start = time.time()
+        start = time.perf_counter_ns()
         result = await callable(*args, **kwargs)
-        end = time.time()
-        delta = end - start
-        logger.info(
-            f'{callable.__qualname__} took {delta} seconds to complete.')
+        end = time.perf_counter_ns()
+        delta = (end - start) / 1e9
+        # The extra fields let log handlers aggregate timings without
+        # parsing the message
+        logger.info('%s took %s seconds to complete.',
+                    callable.__qualname__, delta,
+                    extra={'func': callable.__qualname__, 'duration_s': delta})
         return result
 
     return wrapper
+
+
+def disk_cache(key: Callable[..., str],
+               ttl: float = DISK_CACHE_TTL) -> Callable:
+    """
+    Caches an async callable's results as pickle files in the directory
+    named by the CACHE_DIR environment variable; does nothing if it's unset
+    """
+
+    def decorator(callable: Callable) -> Callable:
+        @functools.wraps(callable)
+        async def wrapper(*args, **kwargs):
+            cache_dir = os.getenv('CACHE_DIR')
+            if not cache_dir:
+                return await callable(*args, **kwargs)
+
+            file_name = os.path.join(
+                cache_dir, key(*args, **kwargs) + '.pickle')
+            try:
+                if time.time() - os.path.getmtime(file_name) < ttl:
+                    with open(file_name, 'rb') as file:
+                        logger.debug('Using cached result from %r', file_name)
+                        return pickle.load(file)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+
+            result = await callable(*args, **kwargs)
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(file_name, 'wb') as file:
+                pickle.dump(result, file)
+            return result
+
+        return wrapper
+
+    return decorator